@@ -0,0 +1,24 @@
+-- 数据库升级脚本
+-- 新版本的数据表模型增加了字段, 已有数据库需要在启动新版本前执行该脚本(或者设置配置项db.auto_migrate为True)
+-- 缺少字段时应用启动会失败并提示缺少的字段
+-- 用法: mysql -u root -p 数据库名 < upgrade.sql
+-- 脚本中的每一段只需要执行一次, 重复执行时添加字段和索引的语句会报告字段或索引已经存在
+
+-- 博客和评论的更新时间(条件请求的版本戳, 搜索索引同步)
+alter table `blogs` add column `updated_at` real not null;
+update `blogs` set `updated_at`=`created_at` where `updated_at`=0;
+alter table `blogs` add key `idx_updated_at` (`updated_at`);
+alter table `blogs` add key `idx_type_updated_at` (`type`, `updated_at`);
+
+alter table `comments` add column `updated_at` double not null;
+update `comments` set `updated_at`=`created_at` where `updated_at`=0;
+
+-- 图片的内容哈希(上传去重), 旧图片的哈希为空字符串, 不参与去重
+alter table `images` add column `hash` varchar(64) not null default '';
+alter table `images` add key `idx_hash` (`hash`);
+
+-- 图片的后缀名, 相同内容和后缀名的图片只保存一条记录(唯一索引防止并发上传时重复插入)
+-- 并发上传已经产生的重复记录不补齐后缀名(保持为NULL), 不影响唯一索引
+alter table `images` add column `ext` varchar(16) null;
+update ignore `images` set `ext`=substring_index(`url`, `hash`, -1) where `ext` is null and `hash`<>'';
+alter table `images` add unique key `idx_hash_ext` (`hash`, `ext`);
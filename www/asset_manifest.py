@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+静态资源指纹
+构建步骤: 计算static目录下每个文件的内容哈希, 复制为带指纹的文件名(css/uikit.min.css -> css/uikit.min.1a2b3c4d.css)
+保存到static/dist目录, 并生成清单文件static/dist/manifest.json(原路径 -> 指纹路径)
+CSS文件中引用的相对路径(字体, 图片)也会被替换为指纹路径
+文件内容变化时URL随之变化, 所以指纹路径可以设置为永久缓存
+最后为文本类静态资源生成预压缩文件(.gz, 安装了brotli时同时生成.br), 服务时直接发送, 不需要每次请求都压缩
+用法: python3 asset_manifest.py
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__author__ = 'Burnell Liu'
+
+
+# 静态文件目录, 指纹文件目录和URL前缀
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+STATIC_PREFIX = '/static/'
+DIST_PREFIX = '/static/dist/'
+MANIFEST_NAME = 'manifest.json'
+
+# 指纹长度
+_HASH_LENGTH = 8
+
+# 图片目录下用户上传的图片和衍生图片目录(按内容哈希, 年份和宽度命名), 不需要生成指纹
+_UPLOAD_DIR_RE = re.compile(r'^(?:[0-9a-f]{2}|\d+|w\d+)$')
+
+# 需要预压缩的文本类文件后缀名, 以及预压缩的最小文件大小(字节)
+COMPRESS_EXTS = ('.css', '.js', '.json', '.svg', '.html', '.txt', '.xml', '.ttf', '.otf', '.eot', '.ico')
+COMPRESS_MIN_SIZE = 256
+
+# CSS中的url()引用
+_CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+# 原路径 -> 指纹路径
+_manifest = dict()
+
+
+def _collect(static_dir):
+    """
+    收集需要生成指纹的文件
+    :param static_dir: 静态文件目录
+    :return: 相对路径列表(使用/分隔)
+    """
+    paths = []
+    for root, dirs, files in os.walk(static_dir):
+        rel_root = os.path.relpath(root, static_dir)
+        if rel_root == '.':
+            dirs[:] = [d for d in dirs if d not in ('dist', 'tmp')]
+        elif rel_root == 'img':
+            dirs[:] = [d for d in dirs if not _UPLOAD_DIR_RE.match(d)]
+        dirs.sort()
+        for name in sorted(files):
+            if name.startswith('.') or name.endswith(('.gz', '.br')):
+                continue
+            paths.append(posixpath.normpath(posixpath.join(rel_root.replace(os.sep, '/'), name)))
+    return paths
+
+
+def fingerprint(path, data):
+    """
+    生成带指纹的文件路径
+    :param path: 原相对路径
+    :param data: 文件内容
+    :return: 带指纹的相对路径
+    """
+    digest = hashlib.md5(data).hexdigest()[:_HASH_LENGTH]
+    base, ext = posixpath.splitext(path)
+    return '%s.%s%s' % (base, digest, ext)
+
+
+def _rewrite_css(path, data, manifest):
+    """
+    将CSS中引用的相对路径替换为指纹路径
+    :param path: CSS文件相对路径
+    :param data: CSS文件内容
+    :param manifest: 已经生成的清单
+    :return: 替换后的CSS文件内容
+    """
+    css_dir = posixpath.dirname(path)
+    hashed_dir = posixpath.dirname(manifest.get(path, path))
+
+    def replace(m):
+        quote, url = m.group(1), m.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return m.group(0)
+        loc = len(url)
+        for c in '?#':
+            n = url.find(c)
+            if n != -1:
+                loc = min(loc, n)
+        target = posixpath.normpath(posixpath.join(css_dir, url[:loc]))
+        hashed = manifest.get(target)
+        if hashed is None:
+            return m.group(0)
+        return 'url(%s%s%s%s)' % (quote, posixpath.relpath(hashed, hashed_dir), url[loc:], quote)
+
+    return _CSS_URL_RE.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    """
+    生成指纹文件和清单文件, 先处理其他文件再处理CSS文件(CSS的指纹依赖引用文件的指纹)
+    :param static_dir: 静态文件目录
+    :param dist_dir: 指纹文件目录, 构建前会被清空
+    :return: 清单字典
+    """
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+
+    paths = _collect(static_dir)
+    manifest = dict()
+    for path in sorted(paths, key=lambda p: p.endswith('.css')):
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            data = _rewrite_css(path, data, manifest)
+        hashed = fingerprint(path, data)
+        manifest[path] = hashed
+
+        target = os.path.join(dist_dir, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+
+    with open(os.path.join(dist_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def _write_compressed(path, suffix, compress, data):
+    """
+    写入预压缩文件, 压缩后没有变小时不写入
+    :param path: 原文件路径
+    :param suffix: 预压缩文件后缀名
+    :param compress: 压缩函数
+    :param data: 原文件内容
+    :return: 写入返回True
+    """
+    target = path + suffix
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+        return False
+    compressed = compress(data)
+    if len(compressed) >= len(data):
+        if os.path.exists(target):
+            os.remove(target)
+        return False
+    with open(target, 'wb') as f:
+        f.write(compressed)
+    return True
+
+
+def precompress(static_dir=STATIC_DIR):
+    """
+    为文本类静态资源生成预压缩文件(.gz和.br), 已经是最新的预压缩文件会被跳过
+    :param static_dir: 静态文件目录
+    :return: 写入的预压缩文件数量
+    """
+    count = 0
+    for root, dirs, files in os.walk(static_dir):
+        for name in files:
+            if not name.lower().endswith(COMPRESS_EXTS):
+                continue
+            path = os.path.join(root, name)
+            if os.path.getsize(path) < COMPRESS_MIN_SIZE:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            if _write_compressed(path, '.gz', lambda d: gzip.compress(d, 9), data):
+                count += 1
+            if brotli is not None and _write_compressed(path, '.br', lambda d: brotli.compress(d, quality=11), data):
+                count += 1
+    return count
+
+
+def load(dist_dir=DIST_DIR):
+    """
+    加载清单文件, 清单文件不存在时使用原路径
+    :param dist_dir: 指纹文件目录
+    """
+    global _manifest
+    path = os.path.join(dist_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        logging.warning('asset manifest not found: %s, serving unfingerprinted assets' % path)
+        _manifest = dict()
+        return
+    with open(path) as f:
+        _manifest = json.load(f)
+    logging.info('loaded asset manifest: %s assets' % len(_manifest))
+
+
+def static_url(path):
+    """
+    获取静态资源URL, 在模板中使用: {{ static_url('css/uikit.min.css') }}
+    :param path: 相对于static目录的路径
+    :return: 清单中存在时返回指纹URL, 否则返回原URL
+    """
+    path = path.lstrip('/')
+    if path.startswith('static/'):
+        path = path[len('static/'):]
+    hashed = _manifest.get(path)
+    if hashed is None:
+        return STATIC_PREFIX + path
+    return DIST_PREFIX + hashed
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    result = build()
+    print('%s assets fingerprinted into %s' % (len(result), DIST_DIR))
+    print('%s pre-compressed files written (brotli %s)' %
+          (precompress(), 'enabled' if brotli is not None else 'not installed'))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上游连接方式性能测试
+分别通过TCP回环地址和Unix域套接字向应用服务器发送HTTP/1.1长连接请求, 比较每秒请求数和p99延迟
+用法: python3 benchmark_upstream.py [--tcp 127.0.0.1:9000] [--unix /path/to/sock] [--path /] [--concurrency 32] [--requests 5000]
+"""
+
+import argparse
+import asyncio
+import time
+
+__author__ = 'Burnell Liu'
+
+
+async def _read_response(reader):
+    """
+    读取一个HTTP响应(只支持Content-Length)
+    :param reader: 流读取对象
+    :return: 响应状态码
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value.strip())
+    if length:
+        await reader.readexactly(length)
+    return status
+
+
+async def _client(connect, request, count, latencies):
+    """
+    单个长连接客户端, 顺序发送指定数量的请求
+    :param connect: 建立连接的协程函数
+    :param request: 请求数据
+    :param count: 请求数量
+    :param latencies: 延迟记录列表
+    """
+    reader, writer = await connect()
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            writer.write(request)
+            await _read_response(reader)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run_benchmark(name, connect, path, concurrency, requests):
+    """
+    运行一组测试并输出结果
+    :param name: 测试名称
+    :param connect: 建立连接的协程函数
+    :param path: 请求路径
+    :param concurrency: 并发连接数
+    :param requests: 总请求数
+    """
+    request = ('GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n' % path).encode('latin-1')
+    latencies = []
+    per_client = max(1, requests // concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(connect, request, per_client, latencies) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p50 = latencies[int(len(latencies) * 0.50)] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    print('%-6s requests: %s, rps: %.1f, p50: %.2fms, p99: %.2fms' %
+          (name, len(latencies), len(latencies) / elapsed, p50, p99))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='compare TCP loopback and Unix domain socket upstream')
+    parser.add_argument('--tcp', default='127.0.0.1:9000', help='TCP address, host:port')
+    parser.add_argument('--unix', default=None, help='Unix domain socket path')
+    parser.add_argument('--path', default='/', help='request path')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent connections')
+    parser.add_argument('--requests', type=int, default=5000, help='total requests')
+    args = parser.parse_args()
+
+    if args.tcp:
+        host, _, port = args.tcp.rpartition(':')
+        await run_benchmark('tcp', lambda: asyncio.open_connection(host, int(port)),
+                            args.path, args.concurrency, args.requests)
+    if args.unix:
+        await run_benchmark('unix', lambda: asyncio.open_unix_connection(args.unix),
+                            args.path, args.concurrency, args.requests)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+验证码池
+预先生成一批验证码(验证码字符, JPEG数据)保存在有界队列中, 获取验证码时只需从队列中取出,
+队列深度低于低水位时, 由执行器的进程池在后台补充, 队列为空时直接在进程池中生成
+"""
+
+import asyncio
+import logging
+from collections import deque
+
+import web_executor
+import web_metrics
+from verify_image import generate_verify_image_bytes
+
+__author__ = 'Burnell Liu'
+
+
+# 每次交给工作进程生成的验证码数量, 减少进程间通信次数
+_BATCH_SIZE = 8
+
+_loop = None
+_font_path = None
+
+# 验证码队列及其容量和低水位
+_queue = deque()
+_capacity = 0
+_low_watermark = 0
+
+# 标记是否正在补充验证码
+_refilling = False
+
+# 统计信息
+_stats = dict(hits=0, misses=0, generated=0, refills=0, errors=0)
+
+
+def generate_batch(font_path, count):
+    """
+    在工作进程中批量生成验证码
+    :param font_path: 生成验证码所用字体路径
+    :param count: 生成数量
+    :return: [(验证码字符, JPEG数据)]
+    """
+    return [generate_verify_image_bytes(font_path) for _ in range(count)]
+
+
+def init(loop, font_path, capacity=64, low_watermark=16):
+    """
+    初始化验证码池, 并开始在后台填充
+    :param loop: 事件循环对象
+    :param font_path: 生成验证码所用字体路径
+    :param capacity: 验证码池容量, 为0时不使用验证码池
+    :param low_watermark: 低水位, 队列深度低于该值时开始补充
+    """
+    global _loop, _font_path, _capacity, _low_watermark
+    _loop = loop
+    _font_path = font_path
+    _capacity = capacity
+    _low_watermark = min(low_watermark, capacity)
+    _schedule_refill()
+
+
+def _schedule_refill():
+    """
+    如果没有正在进行的补充任务, 则启动补充任务
+    """
+    global _refilling
+    if _refilling or _capacity <= 0:
+        return
+    _refilling = True
+    asyncio.ensure_future(_refill(), loop=_loop)
+
+
+async def _refill():
+    """
+    补充验证码直到队列填满
+    """
+    global _refilling
+    _stats['refills'] += 1
+    try:
+        while len(_queue) < _capacity:
+            count = min(_BATCH_SIZE, _capacity - len(_queue))
+            captchas = await web_executor.run_in_process(generate_batch, _font_path, count)
+            _queue.extend(captchas)
+            _stats['generated'] += len(captchas)
+    except Exception as e:
+        _stats['errors'] += 1
+        logging.exception(e)
+    finally:
+        _refilling = False
+
+
+async def get_captcha():
+    """
+    获取一个验证码, 验证码池为空时直接生成
+    :return: (验证码字符, JPEG数据)
+    """
+    try:
+        captcha = _queue.popleft()
+        _stats['hits'] += 1
+        web_metrics.CACHE_REQUESTS.inc(cache='captcha', result='hit')
+    except IndexError:
+        captcha = await web_executor.run_in_process(generate_verify_image_bytes, _font_path)
+        _stats['misses'] += 1
+        web_metrics.CACHE_REQUESTS.inc(cache='captcha', result='miss')
+
+    if len(_queue) < _low_watermark:
+        _schedule_refill()
+    return captcha
+
+
+def get_stats():
+    """
+    获取验证码池统计信息
+    :return: 统计信息字典
+    """
+    stats = dict(_stats)
+    stats['depth'] = len(_queue)
+    stats['capacity'] = _capacity
+    stats['low_watermark'] = _low_watermark
+    stats['refilling'] = _refilling
+    return stats
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+博客评论缓存
+评论只会追加(管理员删除除外), 所以每篇博客的评论列表(已转换为HTML)可以缓存在内存中,
+创建评论时追加到缓存, 删除评论时从缓存中移除
+每次读取时使用评论的版本戳(最后更新时间和数量)验证缓存, 多进程部署时其他进程的修改会被立即发现,
+调用方已经查询过版本戳(例如条件请求的验证器)时直接传入, 不再重复查询
+"""
+
+from collections import OrderedDict
+
+from db_models import Comment
+from web_common import text2html
+from web_conditional import comments_version
+import web_metrics
+
+__author__ = 'Burnell Liu'
+
+
+# 最多缓存的博客数量, 超过后淘汰最久未访问的博客
+_MAX_BLOGS = 256
+
+# 博客ID -> (评论版本戳, 评论列表(按创建时间升序))
+_cache = OrderedDict()
+
+
+def _render(comment):
+    """
+    将评论内容转换为HTML
+    :param comment: 评论对象
+    :return: 评论对象
+    """
+    comment.html_content = text2html(comment.content)
+    return comment
+
+
+async def get_comments(blog_id, version=None):
+    """
+    获取指定博客的评论列表, 缓存未命中或者版本戳变化时从数据库加载
+    :param blog_id: 博客ID
+    :param version: 已知的评论版本戳(最后更新时间, 评论数量), 为None时查询数据库
+    :return: 评论列表
+    """
+    if version is None:
+        version = await comments_version(blog_id)
+    version = tuple(version)
+    cached = _cache.get(blog_id)
+    if cached is not None and cached[0] == version:
+        _cache.move_to_end(blog_id)
+        web_metrics.CACHE_REQUESTS.inc(cache='comments', result='hit')
+        return cached[1]
+
+    web_metrics.CACHE_REQUESTS.inc(cache='comments', result='miss')
+    comments = await Comment.find_all('blog_id=?', [blog_id], order_by='created_at asc')
+    comments = [_render(c) for c in comments]
+    _cache[blog_id] = (version, comments)
+    while len(_cache) > _MAX_BLOGS:
+        _cache.popitem(last=False)
+    return comments
+
+
+def append_comment(comment):
+    """
+    追加新评论到缓存中并更新版本戳, 博客未被缓存时不做处理(下次访问时会从数据库加载)
+    缓存期间其他进程追加的评论会使版本戳不一致, 下次访问时重新加载
+    :param comment: 评论对象
+    """
+    cached = _cache.get(comment.blog_id)
+    if cached is not None:
+        (updated_at, num), comments = cached
+        _cache[comment.blog_id] = ((max(updated_at, comment.updated_at), num + 1),
+                                   comments + [_render(Comment(**comment))])
+
+
+def remove_comment(comment):
+    """
+    从缓存中移除评论, 删除后的版本戳无法在本地计算, 直接移除该博客的缓存
+    :param comment: 评论对象
+    """
+    _cache.pop(comment.blog_id, None)
+
+
+def size():
+    """
+    获取缓存的博客数量
+    :return: 博客数量
+    """
+    return len(_cache)
+
+
+def evict_blog(blog_id):
+    """
+    移除指定博客的评论缓存
+    :param blog_id: 博客ID
+    """
+    _cache.pop(blog_id, None)
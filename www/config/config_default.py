@@ -9,13 +9,73 @@
 __author__ = 'Burnell Liu'
 
 configs = {
+    # 服务器配置信息
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        # Unix域套接字路径, 设置后不再监听TCP端口, 例如'/srv/burnell_web/run/burnellweb.sock'
+        'unix_socket': None,
+        # 监听队列长度
+        'backlog': 1024,
+        # TCP监听时是否设置TCP_NODELAY
+        'tcp_nodelay': True,
+        # HTTP长连接空闲超时(秒), 应大于nginx upstream keepalive_timeout
+        'keepalive_timeout': 75,
+        # 优雅关闭时等待正在处理的请求完成的期限(秒)
+        'shutdown_timeout': 30,
+        # 工作进程数量, 为0时使用CPU核数, 大于1时以主进程+多个工作进程的方式运行
+        # 连接池和执行器按进程数量平分, 进程数量不能超过db.maxsize和executor.threads(为0时自动减少)
+        # 评论缓存, 热门博客, 搜索索引和相关博客保存在各进程内存中, 使用时根据数据库中的版本戳验证,
+        # 其他进程的修改最多延迟conditional.version_interval秒; 趋势排行只统计本进程的阅读
+        'workers': 0
+    },
+
     # 数据库配置信息
     'db': {
         'host': '1.1.1.1',
         'port': 3306,
         'user': 'user',
         'password': 'pwd',
-        'database': 'db'
+        'database': 'db',
+        # 连接池大小, 多进程时平分到各工作进程
+        'maxsize': 10,
+        'minsize': 1,
+        # 是否记录查询语句形态并提供索引建议(/api/db/advisor)
+        'query_advisor': False,
+        # 启动时是否根据模型定义自动建表, 添加缺失的字段和索引
+        'auto_migrate': False
+    },
+
+    # 热门博客排行榜配置信息
+    'hot_blogs': {
+        # 排行榜大小
+        'size': 10,
+        # 从数据库重建排行榜的间隔(秒)
+        'refresh_interval': 600
+    },
+
+    # 趋势博客配置信息
+    'trending': {
+        # 排行榜大小
+        'size': 10,
+        # 热度半衰期(秒)
+        'half_life': 21600
+    },
+
+    # 事件循环监控配置信息(/manage/metrics)
+    'monitor': {
+        # 事件循环延迟采样间隔(秒)
+        'lag_interval': 0.5,
+        # 事件循环阻塞超过该时间(秒)时采集调用栈
+        'block_threshold': 0.2,
+        # 请求处理超过该时间(秒)时记录慢请求
+        'slow_handler': 1.0
+    },
+
+    # 请求查询追踪配置信息
+    'trace': {
+        # 请求执行的查询次数超过该值时记录警告日志, 为0时不检查
+        'max_queries': 10
     },
 
     # 用户COOKIE配置信息
@@ -34,6 +94,84 @@ configs = {
         'name': 'VERIFY_IMAGE_SESSION'
     },
 
+    # 验证码图片配置信息
+    'verify_image': {
+        # 是否直接获取JPEG图片(/api/verifyimage/raw), 否则获取base64编码的JSON数据
+        'raw': False,
+        # 验证码池容量, 为0时每次请求同步生成验证码
+        'pool_size': 64,
+        # 验证码池低水位, 低于该值时在后台补充
+        'pool_low_watermark': 16
+    },
+
+    # 执行器配置信息, CPU密集或阻塞的任务在线程池或进程池中执行
+    'executor': {
+        # 线程池大小
+        'threads': 4,
+        # 进程池大小, 为0时进程任务在线程池中执行
+        'processes': 2
+    },
+
+    # 图片上传配置信息
+    'image_upload': {
+        # 图片大小限制(字节), 应与nginx的client_max_body_size一致
+        'max_size': 2 * 1024 * 1024,
+        # 流式写入的数据块大小(字节)
+        'chunk_size': 64 * 1024
+    },
+
+    # 响应压缩配置信息(nginx已经压缩时可以关闭)
+    'compression': {
+        # 是否压缩HTML和JSON响应
+        'enabled': True,
+        # 响应内容超过该大小(字节)时才压缩
+        'threshold': 1024,
+        # gzip压缩级别(1~9)
+        'level': 6,
+        # 按内容缓存的压缩结果数量, 相同内容的页面只压缩一次
+        'cache_size': 128
+    },
+
+    # 博客搜索配置信息
+    'search': {
+        # 索引快照文件路径, 为None时每次启动都重建索引
+        'snapshot': './search_snapshot.json',
+        # 与数据库同步的间隔(秒), 多进程部署时同步其他进程的修改
+        'sync_interval': 60
+    },
+
+    # 相关博客配置信息
+    'related': {
+        # 每篇博客的相关博客数量
+        'size': 5,
+        # 全量计算间隔(秒), 博客修改时增量计算
+        'rebuild_interval': 600
+    },
+
+    # 订阅源配置信息(/feed.xml)
+    'feed': {
+        # 订阅源中的最新博客数量
+        'size': 20
+    },
+
+    # 条件请求配置信息
+    'conditional': {
+        # 页面中不属于版本戳的内容(阅读次数, 热门和趋势博客)的最长过期时间(秒)
+        'max_stale': 300,
+        # 进程内缓存(热门博客, 搜索索引, 相关博客)查询博客列表版本戳的最小间隔(秒)
+        'version_interval': 1.0
+    },
+
+    # 图片衍生版本配置信息
+    'image_derivatives': {
+        # 缩略图宽度列表
+        'widths': (320, 640, 1024),
+        # JPEG和WebP的压缩质量
+        'quality': 80,
+        # 是否生成WebP版本
+        'webp': True
+    },
+
     # GitHub配置信息
     'github': {
         # GitHub申请的客户端ID
@@ -31,7 +31,7 @@ class UserAuth(Model):
     __table__ = 'user_auth'
 
     id = StringField(primary_key=True, default=generate_id, ddl='varchar(50)')
-    email = StringField(primary_key=False, default=None, ddl='varchar(50)')
+    email = StringField(primary_key=False, default=None, ddl='varchar(50)', unique=True)
     password = StringField(primary_key=False, default=None, ddl='varchar(50)')
 
 
@@ -55,7 +55,7 @@ class UserInfo(Model):
     admin = BooleanField(default=False)
     name = StringField(primary_key=False, default=None, ddl='varchar(50)')
     image = StringField(primary_key=False, default=None, ddl='varchar(500)')
-    created_at = FloatField(primary_key=False, default=time.time)
+    created_at = FloatField(primary_key=False, default=time.time, index=True)
 
 
 class Blog(Model):
@@ -73,12 +73,21 @@ class Blog(Model):
     `read_times` bigint(20) unsigned zerofill NOT NULL DEFAULT '00000000000000000000',
     `type` varchar(50) not null,
     `created_at` real not null,
+    `updated_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_read_times` (`read_times`),
+    key `idx_updated_at` (`updated_at`),
+    key `idx_type_created_at` (`type`, `created_at`),
+    key `idx_type_read_times` (`type`, `read_times`),
+    key `idx_type_updated_at` (`type`, `updated_at`),
     primary key (`id`)
     ) engine=innodb default charset=utf8;
     """
     __table__ = 'blogs'
 
+    # 组合索引: 按类别分页列表, 按类别热门博客, 按类别的最后更新时间(条件请求)
+    __indexes__ = (('type', 'created_at'), ('type', 'read_times'), ('type', 'updated_at'))
+
     id = StringField(primary_key=True, default=generate_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
@@ -86,10 +95,12 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     cover_image = StringField(ddl='varchar(500)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    read_times = IntegerField()
+    content = TextField(ddl='mediumtext')
+    read_times = IntegerField(index=True)
     type = StringField(ddl='varchar(50)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+    # 博客内容的更新时间(不包括阅读次数), 用于条件请求的验证器
+    updated_at = FloatField(default=time.time, index=True)
 
 
 class BlogType(Model):
@@ -121,12 +132,18 @@ class Comment(Model):
     `target_user_name` varchar(50) COLLATE utf8mb4_unicode_ci NOT NULL,
     `content` mediumtext COLLATE utf8mb4_unicode_ci,
     `created_at` double NOT NULL,
+    `updated_at` double NOT NULL,
     PRIMARY KEY (`id`),
-    KEY `idx_created_at` (`created_at`) USING BTREE
+    KEY `idx_created_at` (`created_at`) USING BTREE,
+    KEY `idx_blog_id_created_at` (`blog_id`, `created_at`),
+    KEY `idx_user_id_created_at` (`user_id`, `created_at`)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     """
     __table__ = 'comments'
 
+    # 组合索引: 博客评论列表, 用户评论频率限制
+    __indexes__ = (('blog_id', 'created_at'), ('user_id', 'created_at'))
+
     id = StringField(primary_key=True, default=generate_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -134,8 +151,10 @@ class Comment(Model):
     user_image = StringField(ddl='varchar(500)')
     target_user_id = StringField(ddl='varchar(50)')
     target_user_name = StringField(ddl='varchar(50)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext', nullable=True)
+    created_at = FloatField(default=time.time, index=True)
+    # 评论的更新时间, 用于条件请求的验证器
+    updated_at = FloatField(default=time.time)
 
 
 class Image(Model):
@@ -144,15 +163,36 @@ class Image(Model):
     create table images (
     `id` varchar(50) not null,
     `url` varchar(500) not null,
+    `hash` varchar(64) not null,
+    `ext` varchar(16) null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    unique key `idx_hash_ext` (`hash`, `ext`),
     primary key (`id`)
     ) engine=innodb default charset=utf8;
     """
     __table__ = 'images'
+    # 相同内容和后缀名的图片只有一条记录, 并发上传相同图片时由唯一索引保证
+    __unique_indexes__ = (('hash', 'ext'),)
     id = StringField(primary_key=True, default=generate_id, ddl='varchar(50)')
     url = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    # 图片内容的SHA256哈希, 用于去重, 旧图片为空字符串
+    hash = StringField(default='', ddl='varchar(64)')
+    # 图片后缀名(小写, 包含.), 旧图片为NULL, 不参与唯一索引
+    ext = StringField(default=None, ddl='varchar(16)', nullable=True)
+    created_at = FloatField(default=time.time, index=True)
+
+
+# 所有数据表模型, 用于生成建表语句和迁移
+ALL_MODELS = (UserAuth, UserInfo, Blog, BlogType, Comment, Image)
+
+# 迁移添加字段后需要执行的数据补齐语句, 可以重复执行, 与conf/mysql/upgrade.sql保持一致
+MIGRATION_BACKFILLS = (
+    'update `blogs` set `updated_at`=`created_at` where `updated_at`=0',
+    'update `comments` set `updated_at`=`created_at` where `updated_at`=0',
+    # 已经计算了哈希的图片补齐后缀名(文件名为<哈希><后缀名>), 并发上传产生的重复记录保持为NULL
+    "update ignore `images` set `ext`=substring_index(`url`, `hash`, -1) where `ext` is null and `hash`<>''",
+)
 
 
 async def unit_test_model(loop):
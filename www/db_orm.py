@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import contextvars
+import re
 import logging
+import time
 import aiomysql
 
 __author__ = 'Burnell Liu'
@@ -33,6 +36,31 @@ async def create_pool(loop, **kw):
     )
 
 
+async def close_pool():
+    """
+    关闭连接池, 等待所有连接关闭
+    """
+    global __pool
+    pool = globals().get('__pool')
+    if pool is None:
+        return
+    logging.info('close database connection pool...')
+    pool.close()
+    await pool.wait_closed()
+    __pool = None
+
+
+def get_pool_stats():
+    """
+    获取连接池状态
+    :return: 连接池状态字典(size, freesize, maxsize, minsize), 连接池未创建时返回空字典
+    """
+    pool = globals().get('__pool')
+    if pool is None:
+        return dict()
+    return dict(size=pool.size, freesize=pool.freesize, maxsize=pool.maxsize, minsize=pool.minsize)
+
+
 async def select(sql, args, size=None):
     """
     执行SELECT语句
@@ -42,7 +70,11 @@ async def select(sql, args, size=None):
     :return: 条目
     """
     # logging.info('Sql: %s Args: %s Size:%s' % (sql, args, size))
+    if _advisor_enabled:
+        record_query(sql, args)
+
     global __pool
+    start = time.perf_counter()
     async with __pool.get() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             # SQL语句的占位符是?，而MySQL的占位符是%s，所以需要替换
@@ -51,7 +83,48 @@ async def select(sql, args, size=None):
                 rs = await cur.fetchmany(size)
             else:
                 rs = await cur.fetchall()
-        return rs
+    trace_query(sql, time.perf_counter() - start, len(rs))
+    return rs
+
+
+async def select_stream(sql, args, batch_size=100):
+    """
+    流式执行SELECT语句, 使用服务端游标分批获取记录, 不会一次把全部结果读入内存
+    遍历结束前会一直占用一个连接, 遍历时不要执行耗时操作
+    :param sql: SQL语句
+    :param args: SQL参数
+    :param batch_size: 每批获取的记录数量
+    :return: 逐条返回记录的异步迭代器
+    """
+    if _advisor_enabled:
+        record_query(sql, args)
+
+    start = time.perf_counter()
+    rows = 0
+    async with __pool.get() as conn:
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+            await cur.execute(sql.replace('?', '%s'), args or ())
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                if not rs:
+                    break
+                rows += len(rs)
+                for r in rs:
+                    yield r
+    trace_query(sql, time.perf_counter() - start, rows)
+
+
+# MySQL唯一索引冲突的错误码
+ER_DUP_ENTRY = 1062
+
+
+def is_duplicate_entry(e):
+    """
+    判断异常是否为唯一索引冲突(插入了唯一索引中已经存在的值)
+    :param e: 异常对象
+    :return: 是唯一索引冲突返回True
+    """
+    return isinstance(e, aiomysql.IntegrityError) and len(e.args) > 0 and e.args[0] == ER_DUP_ENTRY
 
 
 async def execute(sql, args, autocommit=True):
@@ -63,6 +136,7 @@ async def execute(sql, args, autocommit=True):
     :return: 受影响的行数
     """
     # logging.info('Sql: %s Args: %s Autocommit:%s' % (sql, args, autocommit))
+    start = time.perf_counter()
     async with __pool.get() as conn:
         if not autocommit:
             await conn.begin()
@@ -76,7 +150,186 @@ async def execute(sql, args, autocommit=True):
             if not autocommit:
                 await conn.rollback()
             raise
-        return affected
+    trace_query(sql, time.perf_counter() - start, affected)
+    return affected
+
+
+# 当前请求的查询记录列表, 由请求追踪中间件设置, 为None时不记录
+_query_trace = contextvars.ContextVar('query_trace', default=None)
+
+
+def start_query_trace():
+    """
+    开始记录当前请求(上下文)执行的查询
+    :return: 查询记录列表, 每项为(SQL指纹, 耗时, 行数), 以及用于结束记录的token
+    """
+    trace = []
+    return trace, _query_trace.set(trace)
+
+
+def stop_query_trace(token):
+    """
+    结束记录当前请求(上下文)执行的查询
+    :param token: start_query_trace返回的token
+    """
+    _query_trace.reset(token)
+
+
+def query_fingerprint(sql):
+    """
+    生成SQL指纹, SQL语句使用?占位符, 所以只需合并空白字符
+    :param sql: SQL语句
+    :return: SQL指纹
+    """
+    return ' '.join(sql.split())
+
+
+def trace_query(sql, duration, rows):
+    """
+    记录查询到当前请求的查询记录中
+    :param sql: SQL语句
+    :param duration: 耗时(秒)
+    :param rows: 返回或受影响的行数
+    """
+    trace = _query_trace.get()
+    if trace is not None:
+        trace.append((query_fingerprint(sql), duration, rows))
+
+
+# 是否记录查询语句形态, 用于索引分析
+_advisor_enabled = False
+
+# 最多记录的查询语句形态数量
+_ADVISOR_MAX_SHAPES = 500
+
+# 查询语句形态 -> [参数样例, 执行次数]
+_query_shapes = dict()
+
+_RE_TABLE = re.compile(r'\bfrom\s+`?(\w+)`?', re.IGNORECASE)
+_RE_WHERE = re.compile(r'\bwhere\s+(.*?)(?:\s+order\s+by\s+|\s+limit\s+|$)', re.IGNORECASE)
+_RE_ORDER_BY = re.compile(r'\border\s+by\s+(.*?)(?:\s+limit\s+|$)', re.IGNORECASE)
+_RE_CONDITION = re.compile(r'^`?(\w+)`?\s*(=|<=|>=|<>|!=|<|>|\blike\b|\bin\b|\bbetween\b)', re.IGNORECASE)
+
+
+def enable_query_advisor(enabled=True):
+    """
+    开启或关闭查询语句形态记录
+    :param enabled: 是否开启
+    """
+    global _advisor_enabled
+    _advisor_enabled = enabled
+    if not enabled:
+        _query_shapes.clear()
+
+
+def record_query(sql, args):
+    """
+    记录查询语句形态, SQL语句使用?占位符, 所以SQL语句本身即为查询形态
+    :param sql: SQL语句
+    :param args: SQL参数
+    """
+    shape = _query_shapes.get(sql)
+    if shape is not None:
+        shape[1] += 1
+    elif len(_query_shapes) < _ADVISOR_MAX_SHAPES:
+        _query_shapes[sql] = [list(args or ()), 1]
+
+
+def recommend_index(sql):
+    """
+    根据查询语句推荐组合索引: 等值条件字段在前, 范围条件字段或排序字段在后
+    :param sql: SQL语句
+    :return: (表名, 字段列表), 不需要索引时返回None
+    """
+    m = _RE_TABLE.search(sql)
+    if not m:
+        return None
+    table = m.group(1)
+
+    equal_columns = []
+    range_column = None
+    m = _RE_WHERE.search(sql)
+    if m:
+        for condition in re.split(r'\s+and\s+', m.group(1), flags=re.IGNORECASE):
+            cm = _RE_CONDITION.match(condition.strip())
+            if not cm:
+                continue
+            column, op = cm.group(1), cm.group(2).lower()
+            if op == '=':
+                if column not in equal_columns:
+                    equal_columns.append(column)
+            elif range_column is None and op not in ('<>', '!=', 'like'):
+                range_column = column
+
+    order_columns = []
+    m = _RE_ORDER_BY.search(sql)
+    if m:
+        for item in m.group(1).split(','):
+            column = item.strip().split()[0].strip('`')
+            if column not in equal_columns:
+                order_columns.append(column)
+
+    columns = list(equal_columns)
+    if range_column is not None:
+        # 范围条件之后的字段无法用于排序, 所以范围字段放在最后
+        columns.append(range_column)
+    else:
+        columns.extend(order_columns)
+
+    if not columns:
+        return None
+    return table, columns
+
+
+def index_ddl(table, columns):
+    """
+    生成添加索引的DDL语句
+    :param table: 表名
+    :param columns: 字段列表
+    :return: DDL语句
+    """
+    return 'alter table `%s` add %s;' % (table, index_definition(index_name(columns), False, columns))
+
+
+async def explain_queries():
+    """
+    对记录的所有查询语句形态执行EXPLAIN, 标记全表扫描和文件排序, 并给出组合索引建议
+    :return: 分析报告列表, 每项包含sql, count, plan, full_scan, filesort, index
+    """
+    global __pool
+    reports = []
+    for sql, (args, count) in list(_query_shapes.items()):
+        # 直接使用连接执行, EXPLAIN语句本身不需要记录
+        async with __pool.get() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute('explain ' + sql.replace('?', '%s'), args)
+                plan = await cur.fetchall()
+
+        full_scan = any(row.get('type') == 'ALL' for row in plan)
+        filesort = any('filesort' in (row.get('Extra') or '') for row in plan)
+        report = dict(sql=sql, count=count, plan=plan, full_scan=full_scan, filesort=filesort, index=None)
+        if full_scan or filesort:
+            recommended = recommend_index(sql)
+            if recommended:
+                report['index'] = index_ddl(*recommended)
+        reports.append(report)
+    return reports
+
+
+async def recommend_indexes(reports=None):
+    """
+    根据运行时记录的查询语句, 生成推荐的索引DDL语句(已去重)
+    :param reports: explain_queries返回的分析报告, 为None时重新分析
+    :return: DDL语句列表
+    """
+    if reports is None:
+        reports = await explain_queries()
+    ddl_list = []
+    for report in reports:
+        ddl = report['index']
+        if ddl and ddl not in ddl_list:
+            ddl_list.append(ddl)
+    return ddl_list
 
 
 def create_args_string(num):
@@ -86,60 +339,93 @@ def create_args_string(num):
     return ', '.join(array)
 
 
+def index_definition(name, unique, columns):
+    """
+    生成索引的DDL定义
+    :param name: 索引名称
+    :param unique: 是否为唯一索引
+    :param columns: 字段列表
+    :return: DDL字符串
+    """
+    return '%skey `%s` (%s)' % ('unique ' if unique else '', name, ', '.join(map(lambda c: '`%s`' % c, columns)))
+
+
 class Field(object):
     """
     数据库表字段基类
     """
-    def __init__(self, column_type, primary_key, default):
+    def __init__(self, column_type, primary_key, default, index=False, unique=False, nullable=False):
         """
         表字段构造函数
         :param column_type: 字段类型
         :param primary_key: 标记是否为主键
         :param default: 默认值
+        :param index: 标记是否为该字段建立索引
+        :param unique: 标记是否为该字段建立唯一索引
+        :param nullable: 标记该字段是否可以为NULL
         """
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
+        self.unique = unique
+        self.nullable = nullable
+
+    def column_definition(self):
+        """
+        生成字段的DDL定义(不包含字段名)
+        :return: DDL字符串
+        """
+        return '%s %s' % (self.column_type, 'null' if self.nullable and not self.primary_key else 'not null')
 
 
 class StringField(Field):
     """
     字符串字段类
     """
-    def __init__(self, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(ddl, primary_key, default)
+    def __init__(self, primary_key=False, default=None, ddl='varchar(100)', **kw):
+        super().__init__(ddl, primary_key, default, **kw)
 
 
 class BooleanField(Field):
     """
     布尔字段类
     """
-    def __init__(self, default=False):
-        super().__init__('boolean', False, default)
+    def __init__(self, default=False, **kw):
+        super().__init__('boolean', False, default, **kw)
 
 
 class IntegerField(Field):
     """
     整数字段类
     """
-    def __init__(self, primary_key=False, default=0):
-        super().__init__('bigint', primary_key, default)
+    def __init__(self, primary_key=False, default=0, **kw):
+        super().__init__('bigint', primary_key, default, **kw)
 
 
 class FloatField(Field):
     """
     浮点数字段类
     """
-    def __init__(self, primary_key=False, default=0.0):
-        super().__init__('real', primary_key, default)
+    def __init__(self, primary_key=False, default=0.0, **kw):
+        super().__init__('real', primary_key, default, **kw)
 
 
 class TextField(Field):
     """
     文本字段类
     """
-    def __init__(self, default=None):
-        super().__init__('text', False, default)
+    def __init__(self, default=None, ddl='text', **kw):
+        super().__init__(ddl, False, default, **kw)
+
+
+def index_name(columns):
+    """
+    根据字段列表生成索引名称
+    :param columns: 字段列表
+    :return: 索引名称
+    """
+    return 'idx_%s' % '_'.join(columns)
 
 
 class ModelMetaclass(type):
@@ -180,6 +466,19 @@ class ModelMetaclass(type):
         for k in field_dict.keys():
             attrs.pop(k)
 
+        # 索引名称 -> (是否唯一, 字段列表)
+        # 单字段索引由字段的index/unique参数声明, 组合索引由__indexes__声明, 组合唯一索引由__unique_indexes__声明
+        index_dict = dict()
+        for k, v in field_dict.items():
+            if v.unique or v.index:
+                index_dict[index_name([k])] = (v.unique, [k])
+        for unique, key in ((False, '__indexes__'), (True, '__unique_indexes__')):
+            for columns in attrs.pop(key, ()):
+                for column in columns:
+                    if column not in field_dict:
+                        raise BaseException('Index field not found: %s' % column)
+                index_dict[index_name(columns)] = (unique, list(columns))
+
         escaped_fields = list(map(lambda f: '`%s`' % f, field_key_list))
 
         # 字段名和列的映射关系
@@ -193,6 +492,10 @@ class ModelMetaclass(type):
 
         # 除主键外的字段名
         attrs['__fields__'] = field_key_list
+
+        # 二级索引
+        attrs['__indexes__'] = index_dict
+
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (field_primary_key, ', '.join(escaped_fields), table_name)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % \
                               (table_name, ', '.join(escaped_fields),
@@ -200,6 +503,14 @@ class ModelMetaclass(type):
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % \
                               (table_name, ', '.join(map(lambda f: '`%s`=?' % f, field_key_list)), field_primary_key)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (table_name, field_primary_key)
+
+        # 建表语句, 字段顺序: 主键, 其他字段, 主键约束, 二级索引
+        lines = ['`%s` %s' % (field_primary_key, field_dict[field_primary_key].column_definition())]
+        lines.extend(map(lambda f: '`%s` %s' % (f, field_dict[f].column_definition()), field_key_list))
+        lines.append('primary key (`%s`)' % field_primary_key)
+        lines.extend(map(lambda k: index_definition(k, *index_dict[k]), index_dict))
+        attrs['__create__'] = 'create table if not exists `%s` (\n    %s\n) engine=innodb default charset=%s' % \
+                              (table_name, ',\n    '.join(lines), attrs.get('__charset__', 'utf8mb4'))
         return type.__new__(mcs, name, bases, attrs)
 
 
@@ -341,6 +652,97 @@ class Model(dict, metaclass=ModelMetaclass):
             logging.warning('failed to remove by primary key: affected rows: %s' % rows)
 
 
+async def missing_columns(models):
+    """
+    查询数据库中缺失的字段(表不存在时不检查), 用于启动时检查表结构是否需要升级
+    :param models: 模型类列表
+    :return: (表名, 字段名)列表
+    """
+    rs = await select('select database() _db_', None)
+    schema = rs[0]['_db_']
+
+    missing = []
+    for model in models:
+        rs = await select('select column_name _name_ from information_schema.columns '
+                          'where table_schema=? and table_name=?', [schema, model.__table__])
+        columns = set(map(lambda r: r['_name_'], rs))
+        if not columns:
+            continue
+        missing.extend((model.__table__, f) for f in model.__fields__ if f not in columns)
+    return missing
+
+
+async def _has_duplicates(model, index_columns, columns):
+    """
+    检查已有数据在指定字段上是否存在重复值, 包含NULL的记录不会违反唯一索引
+    :param model: 模型类
+    :param index_columns: 索引字段列表
+    :param columns: 数据库中已有的字段集合, 新添加的字段所有记录都是默认值
+    :return: 存在重复值返回True
+    """
+    table = model.__table__
+    added = [c for c in index_columns if c not in columns]
+    if added:
+        if any(map(lambda c: model.__mappings__[c].nullable, added)):
+            return False
+        rs = await select('select count(*) _num_ from `%s`' % table, None)
+        return rs[0]['_num_'] > 1
+    names = ', '.join(map(lambda c: '`%s`' % c, index_columns))
+    not_null = ' and '.join(map(lambda c: '`%s` is not null' % c, index_columns))
+    rs = await select('select 1 from `%s` where %s group by %s having count(*) > 1 limit 1' %
+                      (table, not_null, names), None)
+    return len(rs) > 0
+
+
+async def migrate(models, apply=True):
+    """
+    对比模型定义和数据库(information_schema)中的表结构, 生成并执行迁移语句
+    只会新建缺失的表, 添加缺失的字段和索引, 不会修改或删除已有的字段和索引
+    已有数据存在重复值时无法添加唯一索引, 记录警告并跳过该索引, 需要清理重复数据后再次迁移
+    :param models: 模型类列表
+    :param apply: 是否执行迁移语句, 为False时只返回迁移语句
+    :return: 迁移语句列表
+    """
+    rs = await select('select database() _db_', None)
+    schema = rs[0]['_db_']
+
+    statements = []
+    for model in models:
+        table = model.__table__
+        rs = await select('select table_name _name_ from information_schema.tables '
+                          'where table_schema=? and table_name=?', [schema, table])
+        if len(rs) == 0:
+            statements.append(model.__create__)
+            continue
+
+        rs = await select('select column_name _name_ from information_schema.columns '
+                          'where table_schema=? and table_name=?', [schema, table])
+        columns = set(map(lambda r: r['_name_'], rs))
+        for f in model.__fields__:
+            if f not in columns:
+                statements.append('alter table `%s` add column `%s` %s' %
+                                  (table, f, model.__mappings__[f].column_definition()))
+
+        rs = await select('select distinct index_name _name_ from information_schema.statistics '
+                          'where table_schema=? and table_name=?', [schema, table])
+        indexes = set(map(lambda r: r['_name_'], rs))
+        for name, (unique, index_columns) in model.__indexes__.items():
+            if name in indexes:
+                continue
+            if unique and await _has_duplicates(model, index_columns, columns):
+                logging.warning('migrate: skip unique index `%s`.`%s`, duplicate values exist in (%s)' %
+                                (table, name, ', '.join(index_columns)))
+                continue
+            statements.append('alter table `%s` add %s' %
+                              (table, index_definition(name, unique, index_columns)))
+
+    if apply:
+        for sql in statements:
+            logging.info('migrate: %s' % sql)
+            await execute(sql, None)
+    return statements
+
+
 def unit_test_connection_pool():
     event_loop = asyncio.get_event_loop()
     event_loop.run_until_complete(create_pool(event_loop,
@@ -360,8 +762,8 @@ def unit_test_model():
         # 表字段名id, 整形, 主键, 默认值为0
         id = IntegerField(primary_key=True)
 
-        # 表字段名name, 字符串, 默认值为None
-        name = StringField()
+        # 表字段名name, 字符串, 默认值为None, 建立索引
+        name = StringField(index=True)
 
         # 表字段名age, 整形. 默认值为0
         age = IntegerField()
@@ -375,6 +777,7 @@ def unit_test_model():
     print('Insert: %s' % User.__insert__)
     print('Update: %s' % User.__update__)
     print('Delete: %s' % User.__delete__)
+    print('Create: %s' % User.__create__)
 
     user = User(id=123, name='Michael')
     print('Test user id: %s' % user['id'])
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+订阅源和站点地图
+/feed.xml(RSS 2.0)和/sitemap.xml使用流式查询生成, 只查询需要的字段, 不读取博客内容
+每篇博客的XML片段按博客的更新时间缓存, 博客修改后只重新生成变化的片段, 再拼接为完整文档
+完整文档和gzip压缩版本按博客列表的版本戳缓存, 博客创建, 更新和删除都会改变版本戳(多进程部署时同样有效),
+版本戳没有变化时不需要再生成和压缩文档
+"""
+
+import gzip
+import time
+from email.utils import formatdate
+from urllib.parse import quote
+from xml.sax.saxutils import escape, quoteattr
+
+from db_orm import select_stream
+import web_metrics
+
+__author__ = 'Burnell Liu'
+
+
+# 订阅源查询的博客字段
+_FEED_COLUMNS = ('id', 'name', 'summary', 'type', 'created_at', 'updated_at')
+
+# 预压缩文档的gzip压缩级别, 文档生成后会被多次发送, 使用最高压缩级别
+_GZIP_LEVEL = 9
+
+_domain = ''
+_title = ''
+_feed_size = 20
+
+# 博客ID -> (更新时间, 订阅源条目XML片段)
+_feed_items = dict()
+
+# 博客ID -> (更新时间, 站点地图URL XML片段)
+_sitemap_urls = dict()
+
+# 文档名称 -> (版本戳, 文档内容, gzip压缩后的文档内容)
+_documents = dict()
+
+
+def init(domain, title, feed_size=20):
+    """
+    初始化订阅源和站点地图参数
+    :param domain: 网站域名(包含协议), 用于生成绝对URL
+    :param title: 网站名称
+    :param feed_size: 订阅源中的博客数量
+    """
+    global _domain, _title, _feed_size
+    _domain = domain.rstrip('/')
+    _title = title
+    _feed_size = feed_size
+    _feed_items.clear()
+    _sitemap_urls.clear()
+    _documents.clear()
+
+
+def _w3c_datetime(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(timestamp))
+
+
+def _feed_item(row):
+    """
+    生成订阅源条目
+    :param row: 博客记录
+    :return: XML片段
+    """
+    link = escape('%s/blog/%s' % (_domain, row['id']))
+    return ('<item><title>%s</title><link>%s</link><guid isPermaLink="true">%s</guid>'
+            '<description>%s</description><category>%s</category><pubDate>%s</pubDate></item>\n' %
+            (escape(row['name']), link, link, escape(row['summary']), escape(row['type']),
+             formatdate(row['created_at'], usegmt=True)))
+
+
+def _sitemap_url(path, last_modified=None):
+    """
+    生成站点地图URL条目
+    :param path: 页面路径
+    :param last_modified: 页面最后修改时间, 为None时不输出
+    :return: XML片段
+    """
+    if last_modified is None:
+        return '<url><loc>%s</loc></url>\n' % escape(_domain + path)
+    return '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+        escape(_domain + path), _w3c_datetime(last_modified))
+
+
+async def _build_feed(updated_at):
+    """
+    生成订阅源文档, 未变化的博客复用已经生成的条目
+    :param updated_at: 博客最后更新时间
+    :return: 文档内容
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel>\n',
+             '<title>%s</title><link>%s/</link><description>%s</description>\n' %
+             (escape(_title), escape(_domain), escape(_title)),
+             '<atom:link href=%s rel="self" type="application/rss+xml"/>\n' % quoteattr(_domain + '/feed.xml')]
+    if updated_at:
+        parts.append('<lastBuildDate>%s</lastBuildDate>\n' % formatdate(updated_at, usegmt=True))
+
+    items = dict()
+    sql = 'select %s from `blogs` order by `created_at` desc limit ?' % \
+          ', '.join(map(lambda c: '`%s`' % c, _FEED_COLUMNS))
+    async for r in select_stream(sql, [_feed_size]):
+        item = _feed_items.get(r['id'])
+        if item is None or item[0] != r['updated_at']:
+            item = (r['updated_at'], _feed_item(r))
+        items[r['id']] = item
+        parts.append(item[1])
+    parts.append('</channel></rss>\n')
+
+    # 只保留仍在订阅源中的博客条目
+    _feed_items.clear()
+    _feed_items.update(items)
+    return ''.join(parts).encode('utf-8')
+
+
+async def _build_sitemap(updated_at, type_names):
+    """
+    生成站点地图文档, 包含首页, 博客列表页面和所有博客详细页面, 未变化的博客复用已经生成的条目
+    :param updated_at: 博客最后更新时间
+    :param type_names: 博客类型名称列表
+    :return: 文档内容
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n',
+             _sitemap_url('/', updated_at or None),
+             _sitemap_url('/blogs', updated_at or None)]
+    for name in type_names:
+        parts.append(_sitemap_url('/blogs?type=%s' % quote(name)))
+
+    urls = dict()
+    async for r in select_stream('select `id`, `updated_at` from `blogs` order by `created_at` desc', None):
+        url = _sitemap_urls.get(r['id'])
+        if url is None or url[0] != r['updated_at']:
+            url = (r['updated_at'], _sitemap_url('/blog/%s' % r['id'], r['updated_at']))
+        urls[r['id']] = url
+        parts.append(url[1])
+    parts.append('</urlset>\n')
+
+    # 删除已经不存在的博客条目
+    _sitemap_urls.clear()
+    _sitemap_urls.update(urls)
+    return ''.join(parts).encode('utf-8')
+
+
+async def _get_document(name, version, build, *args):
+    """
+    获取文档, 版本戳没有变化时使用缓存, 否则重新生成并压缩
+    :param name: 文档名称
+    :param version: 版本戳
+    :param build: 生成文档的协程函数
+    :param args: 生成文档的参数
+    :return: (文档内容, gzip压缩后的文档内容)
+    """
+    document = _documents.get(name)
+    if document is not None and document[0] == version:
+        web_metrics.CACHE_REQUESTS.inc(cache='feeds', result='hit')
+        return document[1], document[2]
+
+    web_metrics.CACHE_REQUESTS.inc(cache='feeds', result='miss')
+    body = await build(*args)
+    _documents[name] = (version, body, gzip.compress(body, _GZIP_LEVEL))
+    return body, _documents[name][2]
+
+
+async def get_feed(version):
+    """
+    获取订阅源文档
+    :param version: 博客列表的版本戳(最后更新时间, 博客数量)
+    :return: (文档内容, gzip压缩后的文档内容)
+    """
+    return await _get_document('feed', tuple(version), _build_feed, version[0])
+
+
+async def get_sitemap(version, blog_types):
+    """
+    获取站点地图文档
+    :param version: 博客列表的版本戳(最后更新时间, 博客数量)
+    :param blog_types: 博客类型的版本信息, (ID, 名称, 级别)列表
+    :return: (文档内容, gzip压缩后的文档内容)
+    """
+    key = (tuple(version), tuple(map(tuple, blog_types)))
+    return await _get_document('sitemap', key, _build_sitemap, version[0], list(map(lambda t: t[1], blog_types)))
+
+
+def size():
+    """
+    获取缓存的XML片段数量
+    :return: 数量
+    """
+    return len(_feed_items) + len(_sitemap_urls)
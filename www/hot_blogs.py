@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+热门博客排行榜
+在内存中维护按阅读次数排序的前N篇博客(全站和每个类别),
+阅读计数时增量更新, 并定期从数据库重建, 首页和博客列表页无需再查询数据库
+获取排行榜时检查博客列表的版本戳, 其他进程创建, 修改或删除博客后立即重建;
+其他进程的阅读次数不属于版本戳, 在定期重建时更新
+"""
+
+import asyncio
+import heapq
+import logging
+
+from db_orm import select
+from web_conditional import current_blogs_version
+
+__author__ = 'Burnell Liu'
+
+
+# 排行榜中保存的博客字段, 不包含博客内容
+_COLUMNS = ('id', 'name', 'cover_image', 'type', 'read_times')
+
+# 排行榜大小
+_size = 10
+
+# 博客ID -> 博客条目(只包含_COLUMNS中的字段)
+_entries = dict()
+
+# 全站排行榜
+_global_board = []
+
+# 类别名称 -> 类别排行榜
+_type_boards = dict()
+
+# 标记是否已经从数据库加载
+_loaded = False
+
+# 加载时博客列表的版本戳
+_version = None
+
+# 正在执行的重建任务, 避免并发请求重复重建
+_refresh_task = None
+
+
+def _sort_key(entry):
+    return entry['read_times']
+
+
+def _build_boards():
+    """
+    根据内存中的博客条目重建所有排行榜
+    """
+    global _global_board, _type_boards
+    _global_board = heapq.nlargest(_size, _entries.values(), key=_sort_key)
+
+    type_entries = dict()
+    for entry in _entries.values():
+        type_entries.setdefault(entry['type'], []).append(entry)
+    _type_boards = dict((t, heapq.nlargest(_size, es, key=_sort_key)) for t, es in type_entries.items())
+
+
+def _promote(board, entry):
+    """
+    阅读次数增加后, 调整博客条目在排行榜中的位置
+    阅读次数只会增加, 所以条目只会向前移动或者从榜外进入榜内
+    :param board: 排行榜
+    :param entry: 博客条目
+    """
+    for i, e in enumerate(board):
+        if e is entry:
+            del board[i]
+            break
+    else:
+        if len(board) >= _size and entry['read_times'] <= board[-1]['read_times']:
+            return
+
+    # 保持降序, 阅读次数相同时后来者排在后面
+    index = len(board)
+    while index > 0 and board[index - 1]['read_times'] < entry['read_times']:
+        index -= 1
+    board.insert(index, entry)
+    del board[_size:]
+
+
+async def refresh(version=None):
+    """
+    从数据库重新加载博客条目并重建排行榜
+    :param version: 加载前查询的博客列表版本戳
+    """
+    global _loaded, _version
+    if version is None:
+        version = await current_blogs_version()
+    rs = await select('select %s from `blogs`' % ', '.join(map(lambda c: '`%s`' % c, _COLUMNS)), None)
+    _entries.clear()
+    for r in rs:
+        _entries[r['id']] = dict(r)
+    _build_boards()
+    _loaded = True
+    _version = version
+
+
+async def ensure_fresh():
+    """
+    博客列表的版本戳变化时(包括其他进程的修改)重建排行榜
+    """
+    global _refresh_task
+    version = await current_blogs_version()
+    if _loaded and version == _version:
+        return
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.ensure_future(refresh(version))
+    await asyncio.shield(_refresh_task)
+
+
+async def refresh_forever(interval):
+    """
+    定期从数据库重建排行榜
+    :param interval: 重建间隔(秒)
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh()
+        except Exception as e:
+            logging.exception(e)
+
+
+def init(loop, size=10, interval=600):
+    """
+    初始化排行榜, 并启动定期重建任务
+    :param loop: 事件循环对象
+    :param size: 排行榜大小
+    :param interval: 重建间隔(秒)
+    :return: 重建任务
+    """
+    global _size
+    _size = size
+    return asyncio.ensure_future(refresh_forever(interval), loop=loop)
+
+
+async def get_hot_blogs(blog_type=None):
+    """
+    获取热门博客列表
+    :param blog_type: 博客类别, 为None时获取全站热门博客
+    :return: 博客条目列表(按阅读次数降序)
+    """
+    await ensure_fresh()
+    if blog_type is None:
+        return list(_global_board)
+    return list(_type_boards.get(blog_type, ()))
+
+
+def get_entry(blog_id):
+    """
+    获取博客条目(不查询数据库)
+    :param blog_id: 博客ID
+    :return: 博客条目, 不存在时返回None
+    """
+    return _entries.get(blog_id)
+
+
+def on_read(blog):
+    """
+    博客阅读次数增加后更新排行榜
+    :param blog: 博客对象
+    """
+    entry = _entries.get(blog.id)
+    if entry is None:
+        on_save(blog)
+        return
+    entry['read_times'] = blog.read_times
+    _promote(_global_board, entry)
+    _promote(_type_boards.setdefault(entry['type'], []), entry)
+
+
+def on_read_id(blog_id):
+    """
+    博客阅读次数增加1后更新排行榜(没有博客对象时使用, 比如条件请求返回304)
+    :param blog_id: 博客ID
+    """
+    entry = _entries.get(blog_id)
+    if entry is None:
+        return
+    entry['read_times'] += 1
+    _promote(_global_board, entry)
+    _promote(_type_boards.setdefault(entry['type'], []), entry)
+
+
+def on_save(blog):
+    """
+    博客创建或更新后更新排行榜
+    :param blog: 博客对象
+    """
+    if not _loaded:
+        return
+    _entries[blog.id] = dict((c, blog.get_value(c)) for c in _COLUMNS)
+    _build_boards()
+
+
+def on_remove(blog_id):
+    """
+    博客删除后更新排行榜
+    :param blog_id: 博客ID
+    """
+    if _entries.pop(blog_id, None) is not None:
+        _build_boards()
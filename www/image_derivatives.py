@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+图片衍生版本
+为上传的图片生成固定宽度的缩略图和WebP版本, 列表页面通过srcset按显示宽度下载合适大小的图片
+衍生图片保存在 static/img/w<宽度>/<原图相对路径>, WebP版本在原文件名后追加.webp,
+上传时在进程池中生成, 也可以在第一次请求时生成, 生成后由nginx或静态路由直接返回
+"""
+
+import asyncio
+import logging
+import ntpath
+import os
+import re
+
+from PIL import Image
+
+import web_executor
+
+__author__ = 'Burnell Liu'
+
+
+# 图片URL前缀和文件目录
+URL_PREFIX = '/static/img/'
+IMAGE_DIR = './static/img/'
+
+# 可以生成衍生版本的图片格式(GIF可能是动画, 保持原图)
+_SOURCE_EXTS = ('.jpg', '.jpeg', '.png')
+
+# 衍生图片的宽度列表, WebP质量, 是否生成WebP版本, 网站域名
+_widths = (320, 640, 1024)
+_quality = 80
+_webp = True
+_domain = ''
+
+# 衍生图片目录名称
+_WIDTH_DIR_RE = re.compile(r'^w\d+$')
+
+# 衍生图片路径 -> 正在生成的任务, 避免同一图片被并发重复生成
+_pending = dict()
+
+# 最多记忆的路径解析结果数量, 超过后清空重新记忆
+_MAX_MEMO = 4096
+
+# 图片URL -> 相对路径(不是本站可处理的图片时为None), 模板过滤器每次渲染不需要再解析真实路径
+_relative_paths = dict()
+
+# (宽度, 衍生图片相对路径) -> parse_derivative的结果
+_derivatives = dict()
+
+# 已经确认存在的衍生图片路径
+_generated = set()
+
+
+def _remember(memo, key, value):
+    """
+    记忆路径解析结果
+    :param memo: 记忆字典
+    :param key: 键
+    :param value: 解析结果
+    :return: 解析结果
+    """
+    if len(memo) >= _MAX_MEMO:
+        memo.clear()
+    memo[key] = value
+    return value
+
+
+def _forget(rel):
+    """
+    清除图片的衍生图片记忆, 删除图片后调用
+    :param rel: 原图相对路径
+    """
+    for key in list(_derivatives):
+        if key[1] in (rel, rel + '.webp'):
+            parsed = _derivatives.pop(key)
+            if parsed is not None:
+                _generated.discard(parsed[1])
+
+
+def init(widths=(320, 640, 1024), quality=80, webp=True, domain=''):
+    """
+    初始化衍生图片参数
+    :param widths: 衍生图片的宽度列表
+    :param quality: JPEG和WebP的压缩质量
+    :param webp: 是否生成WebP版本
+    :param domain: 网站域名, 图片URL包含该域名时视为本站图片
+    """
+    global _widths, _quality, _webp, _domain
+    _widths = tuple(sorted(widths))
+    _quality = quality
+    _webp = webp
+    _domain = domain
+    _relative_paths.clear()
+    _derivatives.clear()
+    _generated.clear()
+
+
+def _resolve(*parts):
+    """
+    将相对于图片目录的路径解析为真实路径, 防止通过绝对路径, 盘符, ..或者符号链接访问图片目录以外的文件
+    :param parts: 相对路径的各部分
+    :return: 真实路径, 不在图片目录下时返回None
+    """
+    for part in parts:
+        if not part or part.startswith(('/', '\\')) or ntpath.splitdrive(part)[0]:
+            return None
+    root = os.path.realpath(IMAGE_DIR)
+    path = os.path.realpath(os.path.join(root, *parts))
+    if path == root or os.path.commonpath([root, path]) != root:
+        return None
+    return path
+
+
+def _relative_path(url):
+    """
+    获取本站图片相对于图片目录的路径, 结果按URL记忆
+    :param url: 图片URL(可以包含域名)
+    :return: 相对路径, 不是本站可处理的图片时返回None
+    """
+    if not url:
+        return None
+    if url in _relative_paths:
+        return _relative_paths[url]
+    return _remember(_relative_paths, url, _parse_relative_path(url))
+
+
+def _parse_relative_path(url):
+    """
+    解析本站图片相对于图片目录的路径
+    :param url: 图片URL(可以包含域名)
+    :return: 相对路径, 不是本站可处理的图片时返回None
+    """
+    if _domain and url.startswith(_domain):
+        url = url[len(_domain):]
+    if not url.startswith(URL_PREFIX):
+        return None
+    rel = url[len(URL_PREFIX):]
+    if '..' in rel or not rel.lower().endswith(_SOURCE_EXTS) or _resolve(rel) is None:
+        return None
+    return rel
+
+
+def derivative_url(url, width, fmt=None):
+    """
+    获取图片指定宽度的衍生版本URL
+    :param url: 原图URL
+    :param width: 宽度
+    :param fmt: 为'webp'时返回WebP版本, 否则保持原格式
+    :return: 衍生图片URL, 不能生成衍生版本时返回原图URL
+    """
+    rel = _relative_path(url)
+    if rel is None or width not in _widths:
+        return url
+    if fmt == 'webp':
+        rel += '.webp'
+    return '%sw%s/%s' % (URL_PREFIX, width, rel)
+
+
+def thumbnail_filter(url, width=None, fmt=None):
+    """
+    缩略图过滤器, 在模板中使用: {{ blog.cover_image|thumbnail(640) }}
+    :param url: 原图URL
+    :param width: 宽度, 默认为最大的衍生宽度
+    :param fmt: 为'webp'时返回WebP版本
+    :return: 衍生图片URL
+    """
+    if width is None:
+        width = _widths[-1]
+    return derivative_url(url, width, fmt)
+
+
+def srcset_filter(url, fmt=None):
+    """
+    srcset过滤器, 在模板中使用: <img srcset="{{ blog.cover_image|srcset }}">
+    :param url: 原图URL
+    :param fmt: 为'webp'时返回WebP版本的srcset
+    :return: srcset字符串, 不能生成衍生版本时返回原图URL(WebP版本返回空字符串, 浏览器会忽略该来源)
+    """
+    rel = _relative_path(url)
+    if fmt == 'webp' and (not _webp or rel is None):
+        return ''
+    if rel is None:
+        return url
+    return ', '.join(map(lambda w: '%s %sw' % (derivative_url(url, w, fmt), w), _widths))
+
+
+def parse_derivative(width, rel):
+    """
+    解析衍生图片请求
+    :param width: 宽度
+    :param rel: 衍生图片相对路径(WebP版本以.webp结尾)
+    :return: (原图路径, 衍生图片路径, 格式), 请求无效时返回None
+    """
+    if width not in _widths or '..' in rel:
+        return None
+    fmt = None
+    source_rel = rel
+    if rel.endswith('.webp'):
+        if not _webp:
+            return None
+        fmt = 'webp'
+        source_rel = rel[:-len('.webp')]
+    if not source_rel.lower().endswith(_SOURCE_EXTS):
+        return None
+    source = _resolve(source_rel)
+    target = _resolve('w%s' % width, rel)
+    if source is None or target is None:
+        return None
+    return source, target, fmt
+
+
+def generate_derivative(source, target, width, fmt=None, quality=80):
+    """
+    生成一个衍生图片, 先写入临时文件再移动到目标路径(在进程池中执行)
+    图片宽度小于目标宽度时不放大, 只重新编码
+    :param source: 原图路径
+    :param target: 衍生图片路径
+    :param width: 宽度
+    :param fmt: 为'webp'时生成WebP版本
+    :param quality: 压缩质量
+    """
+    image = Image.open(source)
+    if image.width > width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+
+    if fmt == 'webp':
+        save_format = 'WEBP'
+    elif source.lower().endswith('.png'):
+        save_format = 'PNG'
+    else:
+        save_format = 'JPEG'
+    if save_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp = '%s.%s.tmp' % (target, os.getpid())
+    image.save(temp, save_format, quality=quality, optimize=True)
+    os.replace(temp, target)
+
+
+def generate_all(source, widths, quality=80, webp=True):
+    """
+    生成图片所有宽度的衍生版本(在进程池中执行)
+    :param source: 原图路径
+    :param widths: 宽度列表
+    :param quality: 压缩质量
+    :param webp: 是否生成WebP版本
+    :return: 生成的衍生图片数量
+    """
+    rel = os.path.relpath(source, os.path.realpath(IMAGE_DIR))
+    count = 0
+    for width in widths:
+        fmts = (None, 'webp') if webp else (None,)
+        for fmt in fmts:
+            target = _resolve('w%s' % width, rel + ('.webp' if fmt else ''))
+            if target is None or os.path.exists(target):
+                continue
+            generate_derivative(source, target, width, fmt, quality)
+            count += 1
+    return count
+
+
+async def ensure_derivative(width, rel):
+    """
+    确保衍生图片已经生成, 没有生成时在进程池中生成
+    :param width: 宽度
+    :param rel: 衍生图片相对路径
+    :return: 衍生图片路径, 请求无效或原图不存在时返回None
+    """
+    key = (width, rel)
+    if key in _derivatives:
+        parsed = _derivatives[key]
+    else:
+        parsed = _remember(_derivatives, key, parse_derivative(width, rel))
+    if parsed is None:
+        return None
+    source, target, fmt = parsed
+    if target in _generated:
+        return target
+    if os.path.exists(target):
+        _generated.add(target)
+        return target
+    if not os.path.exists(source):
+        return None
+
+    task = _pending.get(target)
+    if task is None:
+        task = asyncio.ensure_future(
+            web_executor.run_in_process(generate_derivative, source, target, width, fmt, _quality))
+        _pending[target] = task
+        task.add_done_callback(lambda t: _pending.pop(target, None))
+    await asyncio.shield(task)
+    _generated.add(target)
+    return target
+
+
+def remove_derivative_files(rel):
+    """
+    删除图片的所有衍生图片文件, 包括已经不在配置中的宽度(在线程池中执行)
+    :param rel: 原图相对路径
+    :return: 删除的文件数量
+    """
+    root = os.path.realpath(IMAGE_DIR)
+    if not os.path.isdir(root):
+        return 0
+    count = 0
+    for name in os.listdir(root):
+        if not _WIDTH_DIR_RE.match(name):
+            continue
+        for suffix in ('', '.webp'):
+            path = _resolve(name, rel + suffix)
+            if path is not None and os.path.isfile(path):
+                os.remove(path)
+                count += 1
+    return count
+
+
+async def remove_derivatives(url):
+    """
+    删除图片的所有衍生图片, 删除图片后调用
+    :param url: 图片URL(可以包含域名)
+    :return: 删除的文件数量
+    """
+    rel = _relative_path(url)
+    if rel is None:
+        return 0
+    _forget(rel)
+    try:
+        return await web_executor.run_in_thread(remove_derivative_files, rel)
+    finally:
+        _forget(rel)
+
+
+def schedule(url):
+    """
+    在后台生成图片的所有衍生版本, 上传图片后调用
+    :param url: 图片URL(可以包含域名)
+    """
+    rel = _relative_path(url)
+    if rel is None:
+        return
+
+    async def run():
+        try:
+            count = await web_executor.run_in_process(
+                generate_all, _resolve(rel), _widths, _quality, _webp)
+            logging.info('generated %s derivatives for %s' % (count, rel))
+        except Exception as e:
+            logging.exception(e)
+
+    asyncio.ensure_future(run())
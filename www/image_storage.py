@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+图片存储
+图片按内容寻址存储: 文件路径由内容的SHA256哈希决定(static/img/ab/cd/<hash>.ext),
+相同内容只保存一份, URL不会变化, 可以设置永久缓存
+上传的图片以数据块的方式流式写入临时文件, 写入过程中同时计算内容哈希, 内存中最多只保存一个数据块
+"""
+
+import hashlib
+import os
+import uuid
+
+import web_executor
+
+__author__ = 'Burnell Liu'
+
+
+# 图片URL前缀和临时文件目录(不在static目录下, 避免未完成的文件被访问, 与图片目录在同一文件系统)
+URL_PREFIX = '/static/img/'
+TEMP_DIR = './tmp/images'
+
+
+class AsyncFileWriter(object):
+    """
+    异步文件写入类, 文件的打开, 写入和关闭都在执行器的线程池中进行, 不阻塞事件循环
+    """
+    def __init__(self, path):
+        """
+        构造函数
+        :param path: 文件路径
+        """
+        self.path = path
+        self.__file = None
+
+    async def open(self):
+        self.__file = await web_executor.run_in_thread(open, self.path, 'wb')
+
+    async def write(self, data):
+        await web_executor.run_in_thread(self.__file.write, data)
+
+    async def close(self):
+        if self.__file is not None:
+            await web_executor.run_in_thread(self.__file.close)
+            self.__file = None
+
+    async def abort(self):
+        """
+        关闭并删除文件
+        """
+        await self.close()
+        await web_executor.run_in_thread(_remove_file, self.path)
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class ImageTooLarge(Exception):
+    """
+    上传的图片超过大小限制
+    """
+    pass
+
+
+def content_url(digest, ext):
+    """
+    根据内容哈希生成图片URL(不包含域名), 使用哈希的前两级作为子目录, 避免单个目录下文件过多
+    :param digest: 内容哈希
+    :param ext: 图片后缀名(包含.)
+    :return: 图片URL
+    """
+    return '%s%s/%s/%s%s' % (URL_PREFIX, digest[:2], digest[2:4], digest, ext.lower())
+
+
+def content_path(digest, ext):
+    """
+    根据内容哈希生成图片文件路径
+    :param digest: 内容哈希
+    :param ext: 图片后缀名(包含.)
+    :return: 图片文件路径
+    """
+    return '.' + content_url(digest, ext)
+
+
+def _move_into_place(temp_path, digest, ext):
+    """
+    将临时文件移动到内容哈希对应的路径, 相同内容的文件路径相同, 所以直接覆盖即可
+    :param temp_path: 临时文件路径
+    :param digest: 内容哈希
+    :param ext: 图片后缀名
+    """
+    path = content_path(digest, ext)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+
+
+def _temp_path():
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    return os.path.join(TEMP_DIR, '%s.part' % uuid.uuid4().hex)
+
+
+async def save_stream(field, ext, chunk_size=65536, max_size=2 * 1024 * 1024):
+    """
+    将multipart文件字段流式写入临时文件, 同时计算内容哈希, 完成后移动到内容哈希对应的路径
+    :param field: multipart文件字段
+    :param ext: 图片后缀名(包含.)
+    :param chunk_size: 数据块大小
+    :param max_size: 文件大小限制, 超过时抛出ImageTooLarge
+    :return: (内容哈希, 图片URL)
+    """
+    writer = AsyncFileWriter(await web_executor.run_in_thread(_temp_path))
+    await writer.open()
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = await field.read_chunk(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise ImageTooLarge('image size exceeds %s bytes' % max_size)
+            sha256.update(chunk)
+            await writer.write(chunk)
+        await writer.close()
+    except BaseException:
+        await writer.abort()
+        raise
+
+    digest = sha256.hexdigest()
+    await web_executor.run_in_thread(_move_into_place, writer.path, digest, ext)
+    return digest, content_url(digest, ext)
+
+
+def _save_bytes(data, ext):
+    digest = hashlib.sha256(data).hexdigest()
+    path = content_path(digest, ext)
+    if not os.path.exists(path):
+        temp_path = _temp_path()
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        _move_into_place(temp_path, digest, ext)
+    return digest, content_url(digest, ext)
+
+
+async def save_bytes(data, ext):
+    """
+    保存图片数据到内容哈希对应的路径
+    :param data: 图片数据
+    :param ext: 图片后缀名(包含.)
+    :return: (内容哈希, 图片URL)
+    """
+    return await web_executor.run_in_thread(_save_bytes, data, ext)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+相关博客推荐
+使用搜索索引中的词频为每篇博客生成TF-IDF稀疏向量, 计算余弦相似度最高的前K篇博客, 结果保存在内存中,
+博客详细页面只需一次字典查找即可获得相关博客
+全量计算在进程池中定期执行; 博客修改时只重新计算受影响的博客: 被修改的博客本身,
+以及相关列表中包含该博客或者该博客可以进入其相关列表的博客
+搜索索引与数据库同步后(包括其他进程的修改), 根据博客的更新时间找出变化的博客并增量更新
+"""
+
+import asyncio
+import heapq
+import logging
+import math
+
+import search
+import web_executor
+
+__author__ = 'Burnell Liu'
+
+
+# 参与计算的词的最小长度: 中文单字区分度太低, 只使用两字词和英文单词
+_MIN_TERM_LENGTH = 2
+
+# 出现在超过该比例博客中的词对相似度贡献很小, 忽略这些词以减少计算量
+_MAX_DF_RATIO = 0.5
+
+# 相关博客数量
+_size = 5
+
+# 博客ID -> 相关博客列表[(博客ID, 相似度)], 按相似度降序
+_neighbors = dict()
+
+# 博客ID -> TF-IDF向量的模
+_norms = dict()
+
+# 博客ID -> 计算相关博客时博客的更新时间
+_updated = dict()
+
+# 已经处理的搜索索引修改计数, 为None时还没有全量计算
+_generation = None
+
+
+def _idf(df, n):
+    return math.log(n / df) if df > 0 else 0.0
+
+
+def _weight(tf, idf):
+    return (1.0 + math.log(tf)) * idf
+
+
+def _norm(terms, df_of, n):
+    """
+    计算TF-IDF向量的模
+    :param terms: 词 -> 加权词频
+    :param df_of: 获取词的文档频率的函数
+    :param n: 博客总数
+    :return: 向量的模
+    """
+    total = 0.0
+    for term, tf in terms.items():
+        if len(term) < _MIN_TERM_LENGTH:
+            continue
+        total += _weight(tf, _idf(df_of(term), n)) ** 2
+    return math.sqrt(total)
+
+
+def _similarities(blog_id, terms, postings_of, norms, n):
+    """
+    通过倒排索引计算一篇博客与其他所有博客的余弦相似度, 只访问有共同词的博客
+    :param blog_id: 博客ID
+    :param terms: 博客的词 -> 加权词频
+    :param postings_of: 获取包含指定词的博客的函数
+    :param norms: 博客ID -> 向量的模
+    :param n: 博客总数
+    :return: 博客ID -> 相似度
+    """
+    norm = norms.get(blog_id)
+    if not norm:
+        return dict()
+    max_df = max(2, int(n * _MAX_DF_RATIO))
+    dots = dict()
+    for term, tf in terms.items():
+        if len(term) < _MIN_TERM_LENGTH:
+            continue
+        posting = postings_of(term)
+        if not posting or len(posting) > max_df:
+            continue
+        idf = _idf(len(posting), n)
+        w = _weight(tf, idf)
+        for other, other_tf in posting.items():
+            if other != blog_id:
+                dots[other] = dots.get(other, 0.0) + w * _weight(other_tf, idf)
+
+    similarities = dict()
+    for other, dot in dots.items():
+        other_norm = norms.get(other)
+        if other_norm:
+            similarities[other] = dot / (norm * other_norm)
+    return similarities
+
+
+def _top(similarities, k):
+    return heapq.nlargest(k, similarities.items(), key=lambda kv: kv[1])
+
+
+def compute_all(docs, k):
+    """
+    全量计算所有博客的相关博客(在进程池中执行)
+    :param docs: 博客ID -> (词 -> 加权词频)
+    :param k: 相关博客数量
+    :return: (博客ID -> 相关博客列表, 博客ID -> 向量的模)
+    """
+    n = len(docs)
+    postings = dict()
+    for blog_id, terms in docs.items():
+        for term, tf in terms.items():
+            if len(term) >= _MIN_TERM_LENGTH:
+                postings.setdefault(term, dict())[blog_id] = tf
+
+    df_of = lambda t: len(postings.get(t, ()))
+    norms = dict((blog_id, _norm(terms, df_of, n)) for blog_id, terms in docs.items())
+    neighbors = dict()
+    for blog_id, terms in docs.items():
+        neighbors[blog_id] = _top(_similarities(blog_id, terms, postings.get, norms, n), k)
+    return neighbors, norms
+
+
+async def rebuild():
+    """
+    在进程池中全量计算相关博客
+    """
+    global _neighbors, _norms, _updated, _generation
+    if not search.is_loaded():
+        return
+    generation = search.get_generation()
+    versions = search.get_versions()
+    docs = search.get_documents()
+    _neighbors, _norms = await web_executor.run_in_process(compute_all, docs, _size)
+    _updated = versions
+    _generation = generation
+    logging.info('related blogs rebuilt: %s blogs' % len(_neighbors))
+    # 计算期间的增量修改(本进程的博客修改, 搜索索引同步)作用在替换前的结果上, 替换后重新应用
+    _apply_changes()
+
+
+async def rebuild_forever(interval):
+    """
+    定期全量计算相关博客(修正增量计算时未更新的IDF和其他进程的修改)
+    :param interval: 计算间隔(秒)
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await rebuild()
+        except Exception as e:
+            logging.exception(e)
+
+
+def init(loop, size=5, interval=3600):
+    """
+    初始化相关博客参数, 并启动定期全量计算任务
+    :param loop: 事件循环对象
+    :param size: 相关博客数量
+    :param interval: 全量计算间隔(秒)
+    :return: 计算任务
+    """
+    global _size
+    _size = size
+    return asyncio.ensure_future(rebuild_forever(interval), loop=loop)
+
+
+def _apply_changes():
+    """
+    根据搜索索引中博客的更新时间, 增量更新新增, 修改和删除的博客
+    """
+    global _generation
+    generation = search.get_generation()
+    if _generation is None or generation == _generation:
+        return
+    versions = search.get_versions()
+    for blog_id in [i for i in _updated if i not in versions]:
+        on_remove(blog_id)
+    for blog_id, updated_at in versions.items():
+        if _updated.get(blog_id) != updated_at:
+            on_save(blog_id)
+    _generation = generation
+
+
+async def ensure_fresh():
+    """
+    搜索索引与数据库同步后(包括其他进程的修改), 增量更新变化的博客
+    """
+    await search.ensure_synced()
+    _apply_changes()
+
+
+def _live_n():
+    return max(1, len(_norms))
+
+
+def _recompute(blog_id):
+    """
+    使用搜索索引重新计算一篇博客的相关博客
+    :param blog_id: 博客ID
+    :return: 与其他博客的相似度
+    """
+    terms = search.get_terms(blog_id)
+    if terms is None:
+        _neighbors.pop(blog_id, None)
+        return dict()
+    similarities = _similarities(blog_id, terms, search.get_postings, _norms, _live_n())
+    _neighbors[blog_id] = _top(similarities, _size)
+    return similarities
+
+
+def on_save(blog_id):
+    """
+    博客创建或更新后(搜索索引更新之后)增量更新相关博客
+    :param blog_id: 博客ID
+    """
+    terms = search.get_terms(blog_id)
+    if terms is None:
+        return
+    _updated[blog_id] = search.get_updated_at(blog_id)
+    df_of = lambda t: len(search.get_postings(t) or ())
+    _norms[blog_id] = _norm(terms, df_of, _live_n() + (0 if blog_id in _norms else 1))
+    similarities = _recompute(blog_id)
+
+    # 更新其他博客的相关列表: 只有包含该博客或者该博客可以进入的列表需要变化
+    for other, neighbors in list(_neighbors.items()):
+        if other == blog_id:
+            continue
+        score = similarities.get(other, 0.0)
+        contained = any(map(lambda e: e[0] == blog_id, neighbors))
+        if not contained and (score <= 0 or (len(neighbors) >= _size and score <= neighbors[-1][1])):
+            continue
+        if contained and len(neighbors) >= _size and score < neighbors[-1][1]:
+            # 相似度下降到列表末尾以下, 需要从其他博客中补充
+            _recompute(other)
+            continue
+        neighbors = list(filter(lambda e: e[0] != blog_id, neighbors))
+        if score > 0:
+            neighbors.append((blog_id, score))
+        neighbors.sort(key=lambda e: e[1], reverse=True)
+        _neighbors[other] = neighbors[:_size]
+
+
+def on_remove(blog_id):
+    """
+    博客删除后(搜索索引更新之后)更新相关博客, 相关列表中包含该博客的博客需要重新计算
+    :param blog_id: 博客ID
+    """
+    _neighbors.pop(blog_id, None)
+    _norms.pop(blog_id, None)
+    _updated.pop(blog_id, None)
+    for other, neighbors in list(_neighbors.items()):
+        if any(map(lambda e: e[0] == blog_id, neighbors)):
+            _recompute(other)
+
+
+def get_related_versions(blog_id):
+    """
+    获取相关博客的版本信息, 用于博客详细页面的验证器
+    :param blog_id: 博客ID
+    :return: (博客ID, 更新时间)列表(按相似度降序)
+    """
+    return list(map(lambda e: (e[0], search.get_updated_at(e[0])), _neighbors.get(blog_id, ())))
+
+
+def get_related(blog_id):
+    """
+    获取相关博客
+    :param blog_id: 博客ID
+    :return: 博客条目列表(按相似度降序)
+    """
+    entries = []
+    for other, _ in _neighbors.get(blog_id, ()):
+        entry = search.get_entry(other)
+        if entry is not None:
+            entries.append(entry)
+    return entries
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+博客全文搜索
+在内存中维护博客标题, 摘要和内容的倒排索引, 使用BM25算法对搜索结果排序
+中文没有空格分词, 连续的中日韩文字按单字和相邻两字(bigram)切分, 英文和数字按单词切分
+博客创建, 更新和删除时增量更新索引, 并定期根据博客的更新时间与数据库同步,
+搜索前检查博客列表的版本戳, 多进程部署时其他进程的修改会在下一次搜索时同步
+索引保存为快照文件, 启动时加载快照后只需重新索引有变化的博客
+"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+
+from db_orm import select
+from web_conditional import current_blogs_version
+import web_executor
+
+__author__ = 'Burnell Liu'
+
+
+# 快照文件格式版本, 分词方式变化时需要增加版本号
+_SNAPSHOT_VERSION = 1
+
+# 搜索结果中保存的博客字段, 不包含博客内容
+_COLUMNS = ('id', 'name', 'summary', 'cover_image', 'type', 'read_times', 'created_at')
+
+# 字段权重: 标题和摘要中出现的词比内容中出现的词更重要
+_FIELD_WEIGHTS = (('name', 3.0), ('summary', 2.0), ('content', 1.0))
+
+# BM25参数
+_K1 = 1.2
+_B = 0.75
+
+# 每批在进程池中分词的博客数量
+_BATCH_SIZE = 32
+
+# 中日韩文字(连续)和英文数字单词
+_TOKEN_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+|[a-z0-9]+[+#]*')
+_CJK_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]')
+
+# 博客ID -> 文档(更新时间, 博客条目, 词 -> 加权词频, 加权文档长度)
+_docs = dict()
+
+# 词 -> (博客ID -> 加权词频)
+_postings = dict()
+
+# 所有文档的加权长度之和
+_total_length = 0.0
+
+_snapshot_path = None
+
+# 标记是否已经从数据库加载
+_loaded = False
+
+# 索引与快照相比是否有变化
+_dirty = False
+
+# 索引修改计数, 每次加入或删除文档时增加, 相关博客据此判断是否需要增量更新
+_generation = 0
+
+# 最后一次同步前查询的博客列表版本戳
+_synced_version = None
+
+# 正在执行的同步任务, 避免并发请求重复同步
+_sync_task = None
+
+
+def tokenize(text):
+    """
+    分词: 英文和数字按单词切分, 连续的中日韩文字切分为单字和相邻两字
+    :param text: 文本
+    :return: 词列表
+    """
+    tokens = []
+    for m in _TOKEN_RE.finditer(text.lower()):
+        word = m.group(0)
+        if not _CJK_RE.match(word):
+            tokens.append(word)
+            continue
+        tokens.extend(word)
+        tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def analyze(name, summary, content):
+    """
+    计算博客的加权词频和加权文档长度(在进程池中执行)
+    :param name: 博客标题
+    :param summary: 博客摘要
+    :param content: 博客内容
+    :return: (词 -> 加权词频, 加权文档长度)
+    """
+    fields = dict(name=name or '', summary=summary or '', content=content or '')
+    terms = dict()
+    length = 0.0
+    for field, weight in _FIELD_WEIGHTS:
+        tokens = tokenize(fields[field])
+        length += weight * len(tokens)
+        for token in tokens:
+            terms[token] = terms.get(token, 0.0) + weight
+    return terms, length
+
+
+def analyze_batch(rows):
+    """
+    批量分析博客(在进程池中执行)
+    :param rows: (博客标题, 博客摘要, 博客内容)列表
+    :return: 分析结果列表
+    """
+    return list(map(lambda r: analyze(*r), rows))
+
+
+def _add_doc(blog_id, updated_at, entry, terms, length):
+    """
+    将文档加入索引, 已经存在时先删除
+    """
+    global _total_length, _dirty, _generation
+    _remove_doc(blog_id)
+    _docs[blog_id] = (updated_at, entry, terms, length)
+    for term, tf in terms.items():
+        _postings.setdefault(term, dict())[blog_id] = tf
+    _total_length += length
+    _dirty = True
+    _generation += 1
+
+
+def _remove_doc(blog_id):
+    """
+    从索引中删除文档
+    :return: 文档存在返回True
+    """
+    global _total_length, _dirty, _generation
+    doc = _docs.pop(blog_id, None)
+    if doc is None:
+        return False
+    for term in doc[2]:
+        posting = _postings.get(term)
+        if posting is None:
+            continue
+        posting.pop(blog_id, None)
+        if not posting:
+            del _postings[term]
+    _total_length -= doc[3]
+    _dirty = True
+    _generation += 1
+    return True
+
+
+async def _index_rows(rows):
+    """
+    在进程池中分词, 然后将博客加入索引
+    :param rows: 包含_COLUMNS, content和updated_at字段的博客行列表
+    """
+    for i in range(0, len(rows), _BATCH_SIZE):
+        batch = rows[i:i + _BATCH_SIZE]
+        results = await web_executor.run_in_process(
+            analyze_batch, list(map(lambda r: (r['name'], r['summary'], r['content']), batch)))
+        for r, (terms, length) in zip(batch, results):
+            _add_doc(r['id'], r['updated_at'], dict((c, r[c]) for c in _COLUMNS), terms, length)
+
+
+async def sync(version=None):
+    """
+    根据博客的更新时间与数据库同步: 重新索引新增和修改的博客, 删除已经不存在的博客
+    :param version: 同步前查询的博客列表版本戳
+    """
+    global _loaded, _synced_version
+    if version is None:
+        version = await current_blogs_version()
+    rs = await select('select `id`, `updated_at` from `blogs`', None)
+    versions = dict((r['id'], r['updated_at']) for r in rs)
+
+    removed = [blog_id for blog_id in _docs if blog_id not in versions]
+    for blog_id in removed:
+        _remove_doc(blog_id)
+
+    changed = [blog_id for blog_id, updated_at in versions.items()
+               if blog_id not in _docs or _docs[blog_id][0] != updated_at]
+    for i in range(0, len(changed), _BATCH_SIZE):
+        ids = changed[i:i + _BATCH_SIZE]
+        rows = await select('select %s, `content`, `updated_at` from `blogs` where `id` in (%s)' %
+                            (', '.join(map(lambda c: '`%s`' % c, _COLUMNS)), ', '.join(['?'] * len(ids))), ids)
+        await _index_rows(rows)
+
+    if removed or changed:
+        logging.info('search index synced: %s indexed, %s removed, %s documents' %
+                     (len(changed), len(removed), len(_docs)))
+    _loaded = True
+    _synced_version = version
+
+
+async def ensure_synced():
+    """
+    博客列表的版本戳变化时(包括其他进程的修改)与数据库同步
+    """
+    global _sync_task
+    version = await current_blogs_version()
+    if _loaded and version == _synced_version:
+        return
+    if _sync_task is None or _sync_task.done():
+        _sync_task = asyncio.ensure_future(sync(version))
+    await asyncio.shield(_sync_task)
+
+
+def _load_snapshot(path):
+    """
+    加载快照文件, 快照不存在或版本不一致时忽略
+    :param path: 快照文件路径
+    """
+    global _total_length, _dirty
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning('failed to load search snapshot %s: %s' % (path, e))
+        return
+    if snapshot.get('version') != _SNAPSHOT_VERSION:
+        return
+
+    _docs.clear()
+    _postings.clear()
+    _total_length = 0.0
+    for blog_id, (updated_at, entry, terms, length) in snapshot['docs'].items():
+        _add_doc(blog_id, updated_at, entry, terms, length)
+    _dirty = False
+    logging.info('search snapshot loaded: %s documents' % len(_docs))
+
+
+def _write_snapshot(path, docs):
+    """
+    写入快照文件, 先写入临时文件再替换, 避免写入中断时快照损坏(在线程池中执行)
+    :param path: 快照文件路径
+    :param docs: 文档字典
+    """
+    temp = '%s.%s.tmp' % (path, os.getpid())
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(dict(version=_SNAPSHOT_VERSION, docs=docs), f, ensure_ascii=False)
+    os.replace(temp, path)
+
+
+async def save_snapshot():
+    """
+    索引有变化时保存快照文件
+    """
+    global _dirty
+    if not _snapshot_path or not _dirty:
+        return
+    _dirty = False
+    await web_executor.run_in_thread(_write_snapshot, _snapshot_path, dict(_docs))
+
+
+async def sync_forever(interval):
+    """
+    定期与数据库同步, 并保存快照
+    :param interval: 同步间隔(秒)
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sync()
+            await save_snapshot()
+        except Exception as e:
+            logging.exception(e)
+
+
+async def load():
+    """
+    加载快照并与数据库同步, 启动时调用
+    """
+    _load_snapshot(_snapshot_path)
+    await sync()
+    await save_snapshot()
+
+
+def init(loop, snapshot_path=None, interval=60):
+    """
+    初始化搜索索引参数, 并启动定期同步任务
+    :param loop: 事件循环对象
+    :param snapshot_path: 快照文件路径, 为None时不使用快照
+    :param interval: 与数据库同步的间隔(秒)
+    :return: 同步任务
+    """
+    global _snapshot_path
+    _snapshot_path = snapshot_path
+    return asyncio.ensure_future(sync_forever(interval), loop=loop)
+
+
+async def on_save(blog):
+    """
+    博客创建或更新后更新索引
+    :param blog: 博客对象
+    """
+    if not _loaded:
+        return
+    terms, length = await web_executor.run_in_process(analyze, blog.name, blog.summary, blog.content)
+    _add_doc(blog.id, blog.updated_at, dict((c, blog.get_value(c)) for c in _COLUMNS), terms, length)
+
+
+def on_remove(blog_id):
+    """
+    博客删除后更新索引
+    :param blog_id: 博客ID
+    """
+    _remove_doc(blog_id)
+
+
+def search(query, offset=0, limit=10, blog_type=None):
+    """
+    搜索博客, 使用BM25算法计算相关度
+    查询中的每个词只计算一次, 包含更多查询词的博客排在前面
+    :param query: 查询字符串
+    :param offset: 结果偏移
+    :param limit: 结果数量
+    :param blog_type: 博客类别, 为None时搜索全部博客
+    :return: (结果总数, 博客条目列表, 每个条目增加score字段)
+    """
+    n = len(_docs)
+    terms = set(tokenize(query))
+    if n == 0 or not terms:
+        return 0, []
+
+    avg_length = _total_length / n if _total_length > 0 else 1.0
+    scores = dict()
+    for term in terms:
+        posting = _postings.get(term)
+        if not posting:
+            continue
+        idf = math.log(1.0 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+        for blog_id, tf in posting.items():
+            length = _docs[blog_id][3]
+            score = idf * tf * (_K1 + 1) / (tf + _K1 * (1 - _B + _B * length / avg_length))
+            scores[blog_id] = scores.get(blog_id, 0.0) + score
+
+    if blog_type is not None:
+        scores = dict((k, v) for k, v in scores.items() if _docs[k][1]['type'] == blog_type)
+
+    ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    results = []
+    for blog_id, score in ranked[offset:offset + limit]:
+        entry = dict(_docs[blog_id][1])
+        entry['score'] = score
+        results.append(entry)
+    return len(ranked), results
+
+
+def get_entry(blog_id):
+    """
+    获取博客条目(不查询数据库)
+    :param blog_id: 博客ID
+    :return: 博客条目, 不存在时返回None
+    """
+    doc = _docs.get(blog_id)
+    return doc[1] if doc is not None else None
+
+
+def get_updated_at(blog_id):
+    """
+    获取索引中博客的更新时间
+    :param blog_id: 博客ID
+    :return: 更新时间, 博客不存在时返回None
+    """
+    doc = _docs.get(blog_id)
+    return doc[0] if doc is not None else None
+
+
+def get_versions():
+    """
+    获取索引中所有博客的更新时间
+    :return: 博客ID -> 更新时间
+    """
+    return dict((blog_id, doc[0]) for blog_id, doc in _docs.items())
+
+
+def get_generation():
+    return _generation
+
+
+def get_terms(blog_id):
+    """
+    获取博客的加权词频
+    :param blog_id: 博客ID
+    :return: 词 -> 加权词频, 博客不存在时返回None
+    """
+    doc = _docs.get(blog_id)
+    return doc[2] if doc is not None else None
+
+
+def get_postings(term):
+    """
+    获取包含指定词的博客
+    :param term: 词
+    :return: 博客ID -> 加权词频, 没有博客包含该词时返回None
+    """
+    return _postings.get(term)
+
+
+def get_documents():
+    """
+    获取所有博客的加权词频
+    :return: 博客ID -> (词 -> 加权词频)
+    """
+    return dict((blog_id, doc[2]) for blog_id, doc in _docs.items())
+
+
+def is_loaded():
+    return _loaded
+
+
+def get_stats():
+    """
+    获取搜索索引统计信息
+    :return: 统计信息字典
+    """
+    return dict(documents=len(_docs), terms=len(_postings), loaded=_loaded, dirty=_dirty)
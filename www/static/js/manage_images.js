@@ -268,16 +268,19 @@ function postImageRequestDone(data){
 
 
 /**
- * 提交图片信息
- * @param {Object} data 图片数据
+ * 提交图片文件(multipart/form-data)
+ * @param {File} file 图片文件
  */
-function postImage(data){
+function postImage(file){
+    var formData = new FormData();
+    formData.append('image', file, file.name);
     var opt = {
         type: 'POST',
-        url: '/api/images',
+        url: '/api/images/upload',
         dataType: 'json',
-        data: JSON.stringify(data || {}),
-        contentType: 'application/json'
+        data: formData,
+        processData: false,
+        contentType: false
     };
 
     showDataLoading(true);
@@ -295,6 +298,8 @@ function postImage(data){
  * 预览图片删除处理函数
  */
 function previewImgTrash(){
+    window.selectedImageFile = null;
+
     // 隐藏图片预览
     var $imagePreview = $('#image-preview');
     $imagePreview.hide();
@@ -313,10 +318,10 @@ function previewImgTrash(){
  * 预览图片上传处理函数
  */
 function previewImgUpload(){
-    var imageName = $('#image-preview span').text();
-    var image = $('#image-preview img').attr('src');
-    var imageData = {name: imageName, image: image};
-    postImage(imageData);
+    if (!window.selectedImageFile){
+        return;
+    }
+    postImage(window.selectedImageFile);
 }
 
 
@@ -328,6 +333,7 @@ function selectedImage(element){
     if (!file){
         return;
     }
+    window.selectedImageFile = file;
     var reader = new FileReader();
     reader.onload = function(evt){
         var $imagePreview = $('#image-preview');
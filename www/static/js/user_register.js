@@ -167,6 +167,12 @@ function getVerifyImageRequestDone(data){
  * 发送获取验证码图片请求
  */
 function getVerifyImageRequest(){
+    // 直接获取JPEG图片, 时间戳用于避免缓存
+    if ($('#verify-image').data('raw')){
+        $('#verify-image').attr('src', '/api/verifyimage/raw?t=' + new Date().getTime());
+        return;
+    }
+
     var opt = {
         type: 'GET',
         url: '/api/verifyimage',
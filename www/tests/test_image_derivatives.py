@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+衍生图片路径解析测试
+运行: 在www目录下执行 python3 -m unittest discover tests
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from urllib.parse import unquote
+
+from PIL import Image
+
+import image_derivatives
+import web_executor
+
+__author__ = 'Burnell Liu'
+
+
+class ParseDerivativeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = os.path.realpath(tempfile.mkdtemp())
+        self.image_dir = os.path.join(self.temp, 'img')
+        self.outside = os.path.join(self.temp, 'outside')
+        os.makedirs(os.path.join(self.image_dir, '2020'))
+        os.makedirs(self.outside)
+        with open(os.path.join(self.outside, 'secret.png'), 'wb') as f:
+            f.write(b'not an image')
+        self.old_image_dir = image_derivatives.IMAGE_DIR
+        image_derivatives.IMAGE_DIR = self.image_dir + '/'
+        image_derivatives.init(widths=(320, 640), webp=True)
+
+    def tearDown(self):
+        image_derivatives.IMAGE_DIR = self.old_image_dir
+        image_derivatives.init()
+        shutil.rmtree(self.temp)
+
+    def test_relative_path(self):
+        source, target, fmt = image_derivatives.parse_derivative(320, '2020/a.png.webp')
+        self.assertEqual(source, os.path.join(self.image_dir, '2020', 'a.png'))
+        self.assertEqual(target, os.path.join(self.image_dir, 'w320', '2020', 'a.png.webp'))
+        self.assertEqual(fmt, 'webp')
+
+    def test_absolute_path(self):
+        # /static/img/w320//<绝对路径>
+        rel = os.path.join(self.outside, 'secret.png')
+        self.assertIsNone(image_derivatives.parse_derivative(320, rel))
+        self.assertIsNone(image_derivatives.parse_derivative(320, rel + '.webp'))
+        self.assertIsNone(image_derivatives.parse_derivative(320, '\\outside\\secret.png'))
+
+    def test_encoded_slash(self):
+        # /static/img/w320/%2F<绝对路径>, 路由参数是解码后的路径
+        rel = unquote('%2F' + os.path.join(self.outside, 'secret.png').lstrip('/').replace('/', '%2F'))
+        self.assertIsNone(image_derivatives.parse_derivative(320, rel))
+
+    def test_drive_and_parent(self):
+        self.assertIsNone(image_derivatives.parse_derivative(320, 'C:/secret.png'))
+        self.assertIsNone(image_derivatives.parse_derivative(320, 'C:secret.png'))
+        self.assertIsNone(image_derivatives.parse_derivative(320, '../outside/secret.png'))
+
+    def test_symlink_outside(self):
+        os.symlink(self.outside, os.path.join(self.image_dir, 'link'))
+        self.assertIsNone(image_derivatives.parse_derivative(320, 'link/secret.png'))
+
+    def test_unknown_width(self):
+        self.assertIsNone(image_derivatives.parse_derivative(100, '2020/a.png'))
+
+    def test_remove_derivative_files(self):
+        paths = [os.path.join(self.image_dir, 'w320', '2020', 'a.png'),
+                 os.path.join(self.image_dir, 'w320', '2020', 'a.png.webp'),
+                 os.path.join(self.image_dir, 'w1024', '2020', 'a.png'),
+                 os.path.join(self.image_dir, 'w320', '2020', 'b.png')]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'x')
+        self.assertEqual(image_derivatives.remove_derivative_files('2020/a.png'), 3)
+        self.assertEqual(list(map(os.path.exists, paths)), [False, False, False, True])
+        self.assertEqual(image_derivatives.remove_derivative_files('/outside/secret.png'), 0)
+
+    def test_ensure_after_remove(self):
+        Image.new('RGB', (800, 600)).save(os.path.join(self.image_dir, '2020', 'a.png'))
+        target = os.path.join(self.image_dir, 'w320', '2020', 'a.png')
+        loop = asyncio.new_event_loop()
+        web_executor.init(loop, 1, 0)
+        try:
+            self.assertEqual(loop.run_until_complete(image_derivatives.ensure_derivative(320, '2020/a.png')), target)
+            self.assertTrue(os.path.isfile(target))
+            self.assertEqual(loop.run_until_complete(
+                image_derivatives.remove_derivatives('/static/img/2020/a.png')), 1)
+            self.assertFalse(os.path.exists(target))
+            # 删除后不能再使用记忆的结果, 需要重新生成
+            self.assertEqual(loop.run_until_complete(image_derivatives.ensure_derivative(320, '2020/a.png')), target)
+            self.assertTrue(os.path.isfile(target))
+        finally:
+            web_executor.shutdown()
+            loop.close()
+
+    def test_derivative_url_absolute(self):
+        url = '/static/img//etc/a.png'
+        self.assertEqual(image_derivatives.derivative_url(url, 320), url)
+
+
+if __name__ == '__main__':
+    unittest.main()
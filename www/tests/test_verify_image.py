@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+验证码图片生成测试
+需要TrueType字体的测试通过环境变量VERIFY_IMAGE_FONT指定字体路径, 默认使用DejaVuSerif
+运行: 在www目录下执行 python3 -m unittest discover tests
+"""
+
+import io
+import os
+import unittest
+
+from PIL import Image
+
+import verify_image
+
+__author__ = 'Burnell Liu'
+
+
+FONT_PATH = os.environ.get('VERIFY_IMAGE_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf')
+
+
+class VerifyImageTest(unittest.TestCase):
+
+    def test_background_range(self):
+        image = verify_image.rand_background_image(240, 60)
+        self.assertEqual(image.size, (240, 60))
+        self.assertEqual(image.mode, 'RGB')
+        for low, high in image.getextrema():
+            self.assertGreaterEqual(low, 64)
+            self.assertLessEqual(high, 255)
+
+    def test_background_table(self):
+        self.assertEqual(len(verify_image._BACKGROUND_TABLE), 256)
+        self.assertEqual(verify_image._BACKGROUND_TABLE[0], 64)
+        self.assertEqual(verify_image._BACKGROUND_TABLE[255], 255)
+
+    @unittest.skipUnless(os.path.exists(FONT_PATH), 'font not found: %s' % FONT_PATH)
+    def test_generate_bytes(self):
+        rand_str, data = verify_image.generate_verify_image_bytes(FONT_PATH)
+        self.assertEqual(len(rand_str), 4)
+        self.assertTrue(all(c in 'ABCDEFGHJKMNPQRSTUVWXY3456789' for c in rand_str))
+        image = Image.open(io.BytesIO(data))
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.size, (240, 60))
+
+    @unittest.skipUnless(os.path.exists(FONT_PATH), 'font not found: %s' % FONT_PATH)
+    def test_font_cached(self):
+        self.assertIs(verify_image.load_font(FONT_PATH, 36), verify_image.load_font(FONT_PATH, 36))
+
+
+if __name__ == '__main__':
+    unittest.main()
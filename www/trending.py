@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+趋势博客排行
+每篇博客的阅读事件记录在按小时和按天滚动的环形计数器中, 同时增量计算随时间衰减的热度分数,
+热度分数使用前向衰减(forward decay): 每次阅读累加exp((t - t0) / tau), 所有博客按同一速率衰减,
+所以分数的相对顺序只会在阅读时改变, 排行榜只需在阅读时调整, 无需扫描所有博客
+内存占用为: 博客数量 x (小时桶数量 + 天桶数量)
+"""
+
+import heapq
+import math
+import time
+
+import hot_blogs
+
+__author__ = 'Burnell Liu'
+
+
+# 小时桶数量和天桶数量
+_HOUR_BUCKETS = 24
+_DAY_BUCKETS = 30
+
+# 指数超过该值时重新设置基准时间, 防止分数溢出
+_MAX_EXPONENT = 500.0
+
+# 排行榜大小
+_size = 10
+
+# 衰减时间常数(秒), 由半衰期换算
+_tau = 6 * 3600 / math.log(2)
+
+# 前向衰减的基准时间
+_base_time = time.time()
+
+# 博客ID -> 阅读计数器
+_counters = dict()
+
+# 趋势排行榜(博客ID列表, 按分数降序)
+_board = []
+
+
+class _ViewCounter(object):
+    """
+    单篇博客的阅读计数器
+    """
+    __slots__ = ('score', 'hours', 'last_hour', 'days', 'last_day')
+
+    def __init__(self):
+        self.score = 0.0
+        self.hours = [0] * _HOUR_BUCKETS
+        self.last_hour = 0
+        self.days = [0] * _DAY_BUCKETS
+        self.last_day = 0
+
+    @staticmethod
+    def _roll(buckets, last, current):
+        """
+        滚动环形计数器, 清空从上次写入到当前时间之间过期的桶
+        :param buckets: 环形桶
+        :param last: 上次写入的时间序号
+        :param current: 当前时间序号
+        """
+        for n in range(last + 1, min(current, last + len(buckets)) + 1):
+            buckets[n % len(buckets)] = 0
+
+    def roll(self, now):
+        """
+        将计数器滚动到当前时间
+        :param now: 当前时间
+        """
+        hour = int(now // 3600)
+        if hour > self.last_hour:
+            self._roll(self.hours, self.last_hour, hour)
+            self.last_hour = hour
+        day = int(now // 86400)
+        if day > self.last_day:
+            self._roll(self.days, self.last_day, day)
+            self.last_day = day
+
+    def add(self, now, weight):
+        """
+        记录一次阅读
+        :param now: 当前时间
+        :param weight: 前向衰减权重
+        """
+        self.roll(now)
+        self.hours[self.last_hour % _HOUR_BUCKETS] += 1
+        self.days[self.last_day % _DAY_BUCKETS] += 1
+        self.score += weight
+
+
+def init(size=10, half_life=6 * 3600):
+    """
+    初始化趋势排行
+    :param size: 排行榜大小
+    :param half_life: 热度半衰期(秒)
+    """
+    global _size, _tau
+    _size = size
+    _tau = half_life / math.log(2)
+
+
+def _rebase(now):
+    """
+    重新设置前向衰减的基准时间, 所有分数同比例缩小, 相对顺序不变
+    :param now: 新的基准时间
+    """
+    global _base_time
+    factor = math.exp(-(now - _base_time) / _tau)
+    for counter in _counters.values():
+        counter.score *= factor
+    _base_time = now
+
+
+def _promote(blog_id):
+    """
+    分数增加后, 调整博客在排行榜中的位置
+    :param blog_id: 博客ID
+    """
+    score = _counters[blog_id].score
+    if blog_id in _board:
+        _board.remove(blog_id)
+    elif len(_board) >= _size and score <= _counters[_board[-1]].score:
+        return
+
+    index = len(_board)
+    while index > 0 and _counters[_board[index - 1]].score < score:
+        index -= 1
+    _board.insert(index, blog_id)
+    del _board[_size:]
+
+
+def record_view(blog_id, now=None):
+    """
+    记录博客的一次阅读
+    :param blog_id: 博客ID
+    :param now: 阅读时间, 默认为当前时间
+    """
+    if now is None:
+        now = time.time()
+    if (now - _base_time) / _tau > _MAX_EXPONENT:
+        _rebase(now)
+
+    counter = _counters.get(blog_id)
+    if counter is None:
+        counter = _counters[blog_id] = _ViewCounter()
+    counter.add(now, math.exp((now - _base_time) / _tau))
+    _promote(blog_id)
+
+
+def remove_blog(blog_id):
+    """
+    博客删除后移除其计数器, 并重建排行榜
+    :param blog_id: 博客ID
+    """
+    global _board
+    if _counters.pop(blog_id, None) is None:
+        return
+    _board = heapq.nlargest(_size, _counters, key=lambda k: _counters[k].score)
+
+
+def get_trending_blogs(now=None):
+    """
+    获取趋势博客列表
+    :param now: 当前时间, 默认为当前时间
+    :return: 博客条目列表, 每项包含博客的排行榜字段和score, views_24h, views_30d
+    """
+    if now is None:
+        now = time.time()
+    decay = math.exp(-(now - _base_time) / _tau)
+
+    blogs = []
+    for blog_id in _board:
+        entry = hot_blogs.get_entry(blog_id)
+        if entry is None:
+            continue
+        counter = _counters[blog_id]
+        counter.roll(now)
+        blog = dict(entry)
+        blog['score'] = counter.score * decay
+        blog['views_24h'] = sum(counter.hours)
+        blog['views_30d'] = sum(counter.days)
+        blogs.append(blog)
+    return blogs
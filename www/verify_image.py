@@ -4,7 +4,9 @@
 import random
 import time
 import base64
+import io
 import os
+import functools
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 
 
@@ -18,17 +20,30 @@ def rand_char():
     return char_list[index]
 
 
-# 随机颜色1:
-def rand_background_color():
+# 背景颜色映射表: 将随机字节(0~255)映射到背景颜色分量范围(64~255)
+_BACKGROUND_TABLE = bytes(64 + (i * 192) // 256 for i in range(256))
+
+
+def rand_background_image(width, height):
     """
-    随机产生验证码背景使用的颜色
-    :return: 颜色(r, g, b)
-    :return:
+    随机产生验证码背景图片, 一次性生成所有像素的随机颜色
+    :param width: 图片宽度
+    :param height: 图片高度
+    :return: 背景图片
     """
-    r = random.randint(64, 255)
-    g = random.randint(64, 255)
-    b = random.randint(64, 255)
-    return r, g, b
+    data = os.urandom(width * height * 3).translate(_BACKGROUND_TABLE)
+    return Image.frombuffer('RGB', (width, height), data, 'raw', 'RGB', 0, 1)
+
+
+@functools.lru_cache(maxsize=8)
+def load_font(font_path, size):
+    """
+    加载字体, 字体对象会被缓存, 避免每次生成验证码时重新加载字体文件
+    :param font_path: 字体路径
+    :param size: 字体大小
+    :return: 字体对象
+    """
+    return ImageFont.truetype(font_path, size)
 
 
 # 随机颜色2:
@@ -43,23 +58,20 @@ def rand_text_color():
     return r, g, b
 
 
-def generate_verify_image(font_path):
+def generate_verify_image_bytes(font_path):
     """
-    生成验证码图片
+    生成验证码图片, 图片直接在内存中编码为JPEG
     :param font_path: 生成验证码所用字体路径
-    :return: （图片字符，图片base64编码数据）
+    :return: （图片字符，图片JPEG数据）
     """
     width = 60 * 4
     height = 60
-    image = Image.new('RGB', (width, height), (255, 255, 255))
-    # 创建Font对象:
-    font = ImageFont.truetype(font_path, 36)
+    # 生成随机颜色的背景:
+    image = rand_background_image(width, height)
+    # 获取Font对象:
+    font = load_font(font_path, 36)
     # 创建Draw对象:
     draw = ImageDraw.Draw(image)
-    # 填充每个像素:
-    for x in range(width):
-        for y in range(height):
-            draw.point((x, y), fill=rand_background_color())
 
     # 输出文字:
     rand_str = rand_char()
@@ -72,16 +84,43 @@ def generate_verify_image(font_path):
     # 模糊:
     image = image.filter(ImageFilter.BLUR)
 
-    file_name = './static/img/' + str(time.time())
-    file_name += '.jpg'
-    image.save(file_name, 'jpeg')
+    buffer = io.BytesIO()
+    image.save(buffer, 'jpeg')
+    return rand_str, buffer.getvalue()
+
+
+def jpeg_data_uri(data):
+    """
+    将JPEG数据转换为data URI
+    :param data: JPEG数据
+    :return: data URI字符串
+    """
+    return 'data:image/jpeg;base64,' + bytes.decode(base64.b64encode(data))
 
-    f = open(file_name, 'rb')
-    str_image = b'data:image/jpeg;base64,'
-    str_image += base64.b64encode(f.read())
-    f.close()
-    os.remove(file_name)
 
-    return rand_str, bytes.decode(str_image)
+def generate_verify_image(font_path):
+    """
+    生成验证码图片
+    :param font_path: 生成验证码所用字体路径
+    :return: （图片字符，图片base64编码数据）
+    """
+    rand_str, data = generate_verify_image_bytes(font_path)
+    return rand_str, jpeg_data_uri(data)
+
+
+def benchmark_verify_image(font_path, count=100):
+    """
+    测试生成验证码图片的耗时
+    :param font_path: 生成验证码所用字体路径
+    :param count: 生成次数
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        generate_verify_image(font_path)
+    elapsed = time.perf_counter() - start
+    print('generate %s verify images: %.3fs, %.2fms per image' % (count, elapsed, elapsed * 1000 / count))
 
 
+if __name__ == '__main__':
+    import sys
+    benchmark_verify_image(sys.argv[1] if len(sys.argv) > 1 else '/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf')
@@ -9,16 +9,26 @@ import os
 import time
 import logging
 
-from datetime import datetime
 from aiohttp import web, ClientSession
 
 from config import configs
 from web_core import get, post
+from web_conditional import conditional, blogs_version, blog_version
 from web_common import *
 from db_models import UserAuth, UserInfo, Comment, Blog, BlogType, Image, generate_id
 from web_error import permission_error, data_error
 from session_cookie import user_cookie_generate, verify_image_cookie_generate
-from verify_image import generate_verify_image
+from verify_image import jpeg_data_uri
+import comment_cache
+import hot_blogs
+import trending
+import captcha_pool
+import web_executor
+import image_storage
+import image_derivatives
+import search
+import related
+import db_orm
 
 
 __author__ = 'Burnell Liu'
@@ -240,7 +250,8 @@ async def api_verify_image_get(request):
     :param request: 请求对象
     :return: 验证码图片
     """
-    num_str, image = generate_verify_image(configs.font_path)
+    num_str, image_data = await captcha_pool.get_captcha()
+    image = jpeg_data_uri(image_data)
 
     # 生成验证码图像COOKIE值
     cookie_name = configs.verify_image_cookie.name
@@ -255,7 +266,67 @@ async def api_verify_image_get(request):
     return r
 
 
+@get('/api/verifyimage/raw')
+async def api_verify_image_raw_get(request):
+    """
+    WEB API: 获取验证码图片API函数, 直接返回JPEG数据(比base64编码的JSON小约33%)
+    :param request: 请求对象
+    :return: 验证码图片
+    """
+    num_str, image_data = await captcha_pool.get_captcha()
+
+    # 生成验证码图像COOKIE值
+    cookie_name = configs.verify_image_cookie.name
+    cookie_secret = configs.verify_image_cookie.secret
+    cookie_str = verify_image_cookie_generate(num_str, cookie_secret)
+
+    r = web.Response(body=image_data)
+    r.set_cookie(cookie_name, cookie_str, max_age=86400, httponly=True)
+    r.content_type = 'image/jpeg'
+    r.headers['Cache-Control'] = 'no-store'
+    return r
+
+
+@get('/api/verifyimage/stats')
+async def api_verify_image_stats_get(request):
+    """
+    WEB API: 获取验证码池统计信息API函数
+    :param request: 请求对象
+    :return: 验证码池统计信息
+    """
+    if not is_admin(request):
+        return permission_error()
+
+    return captcha_pool.get_stats()
+
+
+@get('/api/executor/stats')
+async def api_executor_stats_get(request):
+    """
+    WEB API: 获取执行器任务统计信息API函数
+    :param request: 请求对象
+    :return: 每类任务的排队等待时间和执行时间
+    """
+    if not is_admin(request):
+        return permission_error()
+
+    return web_executor.get_stats()
+
+
+async def _api_blog_get_version(request):
+    """
+    博客数据列表验证器: 博客列表的版本戳, 非管理员不进行条件请求处理
+    :param request: 请求对象
+    :return: (版本信息列表, 最后修改时间)
+    """
+    if not is_admin(request):
+        return None
+    updated_at, num = await blogs_version()
+    return [updated_at, num], updated_at
+
+
 @get('/api/blogs')
+@conditional(_api_blog_get_version)
 async def api_blog_get(request):
     """
     获取指定页面的博客数据函数
@@ -279,7 +350,55 @@ async def api_blog_get(request):
     return dict(page=p, blogs=blogs)
 
 
+@get('/api/search')
+async def api_search_get(request):
+    """
+    搜索博客API函数, 按BM25相关度排序
+    :param request: 请求对象
+    :return: 搜索结果数据
+    """
+    qs_parser = QueryStringParser(request.query_string)
+    # 页码不是正整数时使用第一页
+    page_index = max(qs_parser.get_int('page', 1), 1)
+    query = (qs_parser.q or '').strip()
+    if not query:
+        return data_error(u'搜索内容不能为空')
+
+    page_size = 10
+    await search.ensure_synced()
+    num, blogs = search.search(
+        query, offset=(page_index - 1) * page_size, limit=page_size, blog_type=qs_parser.type)
+    p = Pagination(num, page_index, page_size)
+    return dict(page=p, blogs=blogs)
+
+
+@get('/api/trending')
+async def api_trending_get(request):
+    """
+    获取趋势博客API函数, 按随时间衰减的阅读热度排序
+    :param request: 请求对象
+    :return: 趋势博客数据
+    """
+    await hot_blogs.ensure_fresh()
+    return dict(blogs=trending.get_trending_blogs())
+
+
+async def _api_blog_get_one_version(request):
+    """
+    博客数据验证器: 博客的版本戳, 非管理员不进行条件请求处理
+    :param request: 请求对象
+    :return: (版本信息列表, 最后修改时间), 博客不存在时返回None
+    """
+    if not is_admin(request):
+        return None
+    version = await blog_version(request.match_info['blog_id'])
+    if version is None:
+        return None
+    return [version], max(version)
+
+
 @get('/api/blogs/{blog_id}')
+@conditional(_api_blog_get_one_version)
 async def api_blog_get_one(request):
     """
     获取指定ID的博客数据函数
@@ -337,6 +456,9 @@ async def api_blog_create(request):
                 read_times=0,
                 type=blog_type)
     await blog.save()
+    hot_blogs.on_save(blog)
+    await search.on_save(blog)
+    related.on_save(blog.id)
     return blog
 
 
@@ -382,7 +504,11 @@ async def api_blog_update(request):
     blog.content = content.strip()
     blog.cover_image = cover_image.strip()
     blog.type = blog_type.strip()
+    blog.updated_at = time.time()
     await blog.update()
+    hot_blogs.on_save(blog)
+    await search.on_save(blog)
+    related.on_save(blog.id)
     return blog
 
 
@@ -404,6 +530,11 @@ async def api_blog_delete(request):
         return data_error(u'非法blog id')
 
     await blog.remove()
+    comment_cache.evict_blog(blog_id)
+    hot_blogs.on_remove(blog_id)
+    trending.remove_blog(blog_id)
+    search.on_remove(blog_id)
+    related.on_remove(blog_id)
 
     return dict(id=blog_id)
 
@@ -538,36 +669,92 @@ async def api_image_upload(request):
         return data_error(u'图片名有误')
     image_name_ext = image_name_ext[loc:]
 
-    # 先在数据库中生成一条图片的记录
-    image = Image(url='xx')
-    await image.save()
+    # 解码和写文件在线程池中执行, 避免阻塞事件循环
+    image_data = await web_executor.run_in_thread(_decode_image_str, image_str)
+    image_hash, image_url = await image_storage.save_bytes(image_data, image_name_ext)
+    return await _find_or_create_image(image_hash, image_url)
 
-    # 使用图片数据的创建时间做为URL
-    image_url = '/static/img/'
 
-    # 使用年月创建文件夹
-    dt = datetime.fromtimestamp(image.created_at)
-    new_path = './static/img/%s/%s' % (dt.year, dt.month)
-    os.makedirs(new_path, exist_ok=True)
+@post('/api/images/upload')
+async def api_image_multipart_upload(request):
+    """
+    上传图片API函数(multipart/form-data), 图片数据以数据块的方式流式写入磁盘
+    表单中的文件字段名为image
+    :param request: 请求对象
+    :return:
+    """
+    if not is_admin(request):
+        return permission_error()
 
-    image_url += '%s/%s/%s%s%s%s' % \
-                 (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
-    image_url += image_name_ext
+    if not request.content_type.lower().startswith('multipart/'):
+        return data_error(u'非法数据格式, 请使用multipart/form-data格式')
 
-    image.url = (configs.domain_name + image_url)
-    await image.update()
+    # 找到图片文件字段
+    reader = await request.multipart()
+    field = await reader.next()
+    while field is not None and field.name != 'image':
+        field = await reader.next()
+    if field is None or not field.filename:
+        return data_error(u'图片内容不能为空')
 
+    # 取消图片的原始名，只保留后缀名
+    image_name_ext = field.filename
+    loc = image_name_ext.find('.')
+    if loc == -1:
+        return data_error(u'图片名有误')
+    image_name_ext = image_name_ext[loc:]
+
+    try:
+        image_hash, image_url = await image_storage.save_stream(
+            field,
+            image_name_ext,
+            chunk_size=configs.image_upload.chunk_size,
+            max_size=configs.image_upload.max_size)
+    except image_storage.ImageTooLarge:
+        return data_error(u'图片大小不能超过%sKB' % (configs.image_upload.max_size // 1024))
+    return await _find_or_create_image(image_hash, image_url)
+
+
+async def _find_or_create_image(image_hash, image_url):
+    """
+    根据内容哈希和后缀名查找图片记录, 相同内容和后缀名的图片已经存在时直接返回已有记录(文件已被原地覆盖),
+    否则生成新的图片记录, 相同内容但后缀名不同的图片保存在不同的文件中, 各自对应一条记录
+    并发上传相同图片时只有一个请求能插入记录, 其他请求触发唯一索引冲突后读取已有记录
+    :param image_hash: 图片内容哈希
+    :param image_url: 图片URL(不包含域名), 文件名为<内容哈希><后缀名>
+    :return: 图片对象
+    """
+    image_ext = os.path.basename(image_url)[len(image_hash):]
+    images = await Image.find_all('hash=? and ext=?', [image_hash, image_ext])
+    if images:
+        return images[0]
+
+    image = Image(url=configs.domain_name + image_url, hash=image_hash, ext=image_ext)
+    try:
+        await image.save()
+    except Exception as e:
+        if not db_orm.is_duplicate_entry(e):
+            raise
+        images = await Image.find_all('hash=? and ext=?', [image_hash, image_ext])
+        if not images:
+            raise
+        return images[0]
+
+    # 在后台生成缩略图和WebP版本
+    image_derivatives.schedule(image_url)
+    return image
+
+
+def _decode_image_str(image_str):
+    """
+    解码base64编码的图片数据
+    :param image_str: base64编码的图片数据(可以包含data URI前缀)
+    :return: 图片数据
+    """
     image_str = image_str.replace('data:image/png;base64,', '')
     image_str = image_str.replace('data:image/jpeg;base64,', '')
     image_str = image_str.replace('data:image/gif;base64,', '')
-    image_data = base64.b64decode(image_str)
-
-    image_path = '.'
-    image_path += image_url
-    file = open(image_path, 'wb')
-    file.write(image_data)
-    file.close()
-    return image
+    return base64.b64decode(image_str)
 
 
 @post('/api/images/{image_id}/delete')
@@ -594,6 +781,7 @@ async def api_image_delete(request):
     filename += url
     if os.path.exists(filename):
         os.remove(filename)
+    await image_derivatives.remove_derivatives(url)
 
     return dict(id=image_id)
 
@@ -673,6 +861,7 @@ async def api_comment_create(request):
                       target_user_name=target_user_name,
                       content=content.strip())
     await comment.save()
+    comment_cache.append_comment(comment)
     return comment
 
 
@@ -693,4 +882,20 @@ async def api_comment_delete(request):
         return data_error(u'非法comment id')
 
     await c.remove()
+    comment_cache.remove_comment(c)
     return dict(id=comment_id)
+
+
+@get('/api/db/advisor')
+async def api_db_advisor_get(request):
+    """
+    获取数据库查询分析报告API函数, 对运行时记录的查询语句执行EXPLAIN并给出索引建议
+    :param request: 请求对象
+    :return: 查询分析报告和推荐的索引DDL语句
+    """
+    if not is_admin(request):
+        return permission_error()
+
+    reports = await db_orm.explain_queries()
+    indexes = await db_orm.recommend_indexes(reports)
+    return dict(reports=reports, indexes=indexes)
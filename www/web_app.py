@@ -4,16 +4,38 @@
 import logging
 import asyncio
 import os
+import select
+import signal
+import socket
+import sys
+import time
 
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
 import db_orm
+import db_models
+import hot_blogs
+import trending
+import search
+import related
+import image_derivatives
+import asset_manifest
+import captcha_pool
+import web_executor
+import web_monitor
+import web_metrics
+import web_lifecycle
+import web_compress
+import feeds
+import web_conditional
+import comment_cache
 import web_core
 
 from config import configs
 from template_filters import datetime_filter
-from web_middlewares import logger_factory, auth_factory, response_factory
+from web_middlewares import drain_factory, monitor_factory, compress_factory, trace_factory, logger_factory, \
+    auth_factory, conditional_factory, response_factory
 
 __author__ = 'Burnell Liu'
 
@@ -49,34 +71,175 @@ def init_jinja2(app, **kw):
         for name, f in filters.items():
             env.filters[name] = f
 
+    # 设置jinja2的全局函数
+    functions = kw.get('globals', None)
+    if functions is not None:
+        for name, f in functions.items():
+            env.globals[name] = f
+
     # 保存jinja2环境实例
     app['__templating__'] = env
 
 
-async def init_app(event_loop):
+def init_metrics():
+    """
+    设置在输出指标时才收集的仪表(连接池和缓存状态)
+    """
+    web_metrics.DB_POOL.set_collector(
+        lambda: [(dict(state=k), v) for k, v in db_orm.get_pool_stats().items()])
+    web_metrics.CACHE_SIZE.set_collector(
+        lambda: [(dict(cache='comments'), comment_cache.size()),
+                 (dict(cache='captcha'), captcha_pool.get_stats()['depth']),
+                 (dict(cache='compress'), web_compress.size()),
+                 (dict(cache='feeds'), feeds.size())])
+
+
+def create_listen_socket(reuse_port=False):
+    """
+    根据配置创建监听socket: 配置了unix_socket时使用Unix域套接字, 否则使用TCP
+    :param reuse_port: 是否设置SO_REUSEPORT(仅TCP)
+    :return: socket对象
+    """
+    unix_socket = configs.server.unix_socket
+    if unix_socket:
+        # 删除上次运行残留的套接字文件
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(unix_socket)
+        # 允许nginx(www-data)连接
+        os.chmod(unix_socket, 0o666)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Linux上已接受的连接会继承监听socket的TCP_NODELAY
+        if configs.server.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.bind((configs.server.host, configs.server.port))
+    sock.setblocking(False)
+    return sock
+
+
+async def init_app(event_loop, worker_index=0, workers=1, sock=None):
     """
     网站初始化函数
     :param event_loop: 事件循环对象
+    :param worker_index: 工作进程序号
+    :param workers: 工作进程数量, 连接池和执行器的大小会按进程数量平分
+    :param sock: 主进程创建的监听socket, 为None时由本进程创建
     :return: 服务器对象
     """
+    # 启动事件循环监控
+    web_monitor.init(
+        event_loop,
+        interval=configs.monitor.lag_interval,
+        block_threshold=configs.monitor.block_threshold,
+        slow_handler=configs.monitor.slow_handler)
+
+    # 设置监控指标
+    init_metrics()
+
+    # 创建执行器线程池和进程池
+    web_executor.init(
+        event_loop,
+        divide_size(configs.executor.threads, workers, worker_index),
+        divide_size(configs.executor.processes, workers, worker_index))
+
     # 创建数据库连接池
     await db_orm.create_pool(
         loop=event_loop,
         host=configs.db.host,
         user=configs.db.user,
         password=configs.db.password,
-        db=configs.db.database)
+        db=configs.db.database,
+        maxsize=divide_size(configs.db.maxsize, workers, worker_index),
+        minsize=min(configs.db.minsize, divide_size(configs.db.maxsize, workers, worker_index)))
+
+    # 关闭钩子按注册的相反顺序执行: 最后关闭数据库连接池和执行器
+    web_lifecycle.on_shutdown(web_executor.shutdown)
+    web_lifecycle.on_shutdown(db_orm.close_pool)
+
+    # 根据模型定义迁移表结构(建表, 添加缺失的字段和索引), 多进程时只由第一个工作进程执行
+    # 没有开启自动迁移时检查表结构, 缺少字段时所有查询都会失败, 直接停止启动
+    if configs.db.auto_migrate:
+        if worker_index == 0:
+            await db_orm.migrate(db_models.ALL_MODELS)
+            for sql in db_models.MIGRATION_BACKFILLS:
+                await db_orm.execute(sql, None)
+    else:
+        missing = await db_orm.missing_columns(db_models.ALL_MODELS)
+        if missing:
+            raise RuntimeError(
+                'database schema is out of date, missing columns: %s; '
+                'apply conf/mysql/upgrade.sql or set db.auto_migrate to True' %
+                ', '.join(map(lambda m: '%s.%s' % m, missing)))
+
+    # 开启查询语句形态记录, 用于根据实际访问生成索引建议
+    if configs.db.query_advisor:
+        db_orm.enable_query_advisor()
+
+    # 初始化热门博客排行榜
+    hot_blogs.init(event_loop, configs.hot_blogs.size, configs.hot_blogs.refresh_interval)
+    web_lifecycle.on_startup(hot_blogs.refresh)
+
+    # 初始化搜索索引: 启动时加载快照并与数据库同步, 关闭时保存快照
+    search.init(event_loop, configs.search.snapshot, configs.search.sync_interval)
+    web_lifecycle.on_startup(search.load)
+    web_lifecycle.on_shutdown(search.save_snapshot)
+
+    # 初始化相关博客: 搜索索引加载后全量计算, 之后定期全量计算
+    related.init(event_loop, configs.related.size, configs.related.rebuild_interval)
+    web_lifecycle.on_startup(related.rebuild)
+
+    # 初始化趋势博客排行
+    trending.init(configs.trending.size, configs.trending.half_life)
+
+    # 初始化图片衍生版本参数
+    image_derivatives.init(
+        configs.image_derivatives.widths,
+        quality=configs.image_derivatives.quality,
+        webp=configs.image_derivatives.webp,
+        domain=configs.domain_name)
+
+    # 初始化订阅源和站点地图
+    feeds.init(configs.domain_name, configs.website_name, configs.feed.size)
+
+    # 初始化响应压缩
+    web_compress.init(
+        configs.compression.enabled,
+        threshold=configs.compression.threshold,
+        level=configs.compression.level,
+        cache_size=configs.compression.cache_size)
+
+    # 初始化条件请求
+    web_conditional.init(configs.conditional.max_stale, configs.conditional.version_interval)
+
+    # 初始化验证码池
+    captcha_pool.init(
+        event_loop,
+        configs.font_path,
+        capacity=configs.verify_image.pool_size,
+        low_watermark=configs.verify_image.pool_low_watermark)
 
     # 创建网站应用对象
     # middlewares 接收一个列表，列表的元素就是拦截器函数
     # aiohttp内部循环里以倒序分别将url处理函数用拦截器装饰一遍
     # 最后再返回经过全部拦截器装饰过的函数
     # 这样最终调用url处理函数之前或之后就可以进行一些额外的处理
-    middlewares = [logger_factory, auth_factory, response_factory]
+    middlewares = [drain_factory, monitor_factory, compress_factory, trace_factory, logger_factory, auth_factory,
+                   conditional_factory, response_factory]
     web_app = web.Application(loop=event_loop, middlewares=middlewares)
 
-    # 初始化前端模板, 指定的过滤器函数可以在模板文件中使用
-    init_jinja2(web_app, filters=dict(datetime=datetime_filter))
+    # 初始化前端模板, 指定的过滤器函数和全局函数可以在模板文件中使用
+    # 静态资源URL通过清单文件转换为指纹URL
+    asset_manifest.load()
+    init_jinja2(web_app, filters=dict(
+        datetime=datetime_filter,
+        thumbnail=image_derivatives.thumbnail_filter,
+        srcset=image_derivatives.srcset_filter),
+        globals=dict(static_url=asset_manifest.static_url))
 
     # 添加路由函数
     web_core.add_routes(web_app, 'web_routes.py')
@@ -85,18 +248,239 @@ async def init_app(event_loop):
     # 添加静态文件
     web_core.add_static(web_app)
 
-    # 创建服务器
+    # 创建服务器, 多进程TCP监听时使用SO_REUSEPORT, 由内核在各工作进程间分配连接
+    # keepalive_timeout用于nginx upstream长连接复用
+    await web_lifecycle.startup()
+    if sock is None:
+        sock = create_listen_socket(reuse_port=workers > 1)
+    handler = web_app.make_handler(keepalive_timeout=configs.server.keepalive_timeout)
     server = await event_loop.create_server(
-        web_app.make_handler(),
-        '127.0.0.1',
-        9000)
-    logging.info('server started at http://127.0.0.1:9000...')
+        handler,
+        sock=sock,
+        backlog=configs.server.backlog)
+    web_lifecycle.set_server(server, handler)
+    logging.info('server started at %s (worker %s/%s, pid %s)...' %
+                 (server_address(), worker_index + 1, workers, os.getpid()))
     return server
 
 
+def server_address():
+    """
+    获取服务器监听地址
+    :return: 地址字符串
+    """
+    if configs.server.unix_socket:
+        return 'unix:%s' % configs.server.unix_socket
+    return 'http://%s:%s' % (configs.server.host, configs.server.port)
+
+
+def divide_size(total, workers, worker_index):
+    """
+    将池大小平分到各工作进程, 不能整除的部分分给序号较小的进程, 保证总数等于配置值
+    :param total: 总大小
+    :param workers: 工作进程数量
+    :param worker_index: 工作进程序号
+    :return: 本进程的大小, 工作进程数量超过总大小时部分进程为0
+    """
+    return total // workers + (1 if worker_index < total % workers else 0)
+
+
+def resolve_workers():
+    """
+    确定工作进程数量, 每个工作进程至少需要一个数据库连接和一个执行器线程
+    配置为0时使用CPU核数, 但不超过数据库连接池和执行器线程池的大小; 显式配置的数量超过池大小时停止启动
+    :return: 工作进程数量
+    """
+    limit = max(1, min(configs.db.maxsize, configs.executor.threads))
+    workers = configs.server.workers
+    if workers > limit:
+        raise RuntimeError('server.workers (%s) exceeds db.maxsize/executor.threads (%s), '
+                           'every worker needs at least one database connection and one executor thread' %
+                           (workers, limit))
+    if workers <= 0:
+        workers = min(os.cpu_count() or 1, limit)
+    return workers
+
+
+# 滚动重启时等待新工作进程开始监听的期限(秒)
+_READY_TIMEOUT = 60
+
+
+def run_worker(worker_index=0, workers=1, sock=None, ready_fd=None):
+    """
+    运行工作进程: 创建事件循环并启动网站
+    :param worker_index: 工作进程序号
+    :param workers: 工作进程数量
+    :param sock: 主进程创建的监听socket
+    :param ready_fd: 开始监听后写入一个字节通知主进程的管道
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(init_app(loop, worker_index, workers, sock))
+    web_lifecycle.install_signal_handlers(loop, configs.server.shutdown_timeout)
+    if ready_fd is not None:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+    loop.run_forever()
+
+    # 优雅关闭后取消剩余的后台任务(排行榜重建, 事件循环采样等)
+    tasks = [t for t in asyncio.all_tasks(loop) if not t.done()]
+    for t in tasks:
+        t.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+def spawn_worker(worker_index, workers, sock=None):
+    """
+    创建工作进程, 工作进程通过新的解释器运行(fork后exec), 重新加载代码和配置
+    :param worker_index: 工作进程序号
+    :param workers: 工作进程数量
+    :param sock: 主进程创建的监听socket, 由工作进程继承
+    :return: (工作进程ID, 就绪通知管道的读取端)
+    """
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid != 0:
+        os.close(ready_w)
+        return pid, ready_r
+
+    # 子进程: 只有监听socket和就绪通知管道传递给新的解释器, exec失败时直接退出, 不返回到主进程的代码中
+    try:
+        os.close(ready_r)
+        os.set_inheritable(ready_w, True)
+        listen_fd = -1
+        if sock is not None:
+            listen_fd = sock.fileno()
+            os.set_inheritable(listen_fd, True)
+        os.execv(sys.executable, [sys.executable, os.path.abspath(__file__), '--worker',
+                                  str(worker_index), str(workers), str(listen_fd), str(ready_w)])
+    except BaseException as e:
+        logging.exception(e)
+    finally:
+        os._exit(1)
+
+
+def wait_ready(ready_fd, timeout=_READY_TIMEOUT):
+    """
+    等待工作进程开始监听
+    :param ready_fd: 就绪通知管道的读取端, 等待后关闭
+    :param timeout: 等待期限(秒)
+    :return: 工作进程就绪返回True, 超时或者工作进程提前退出返回False
+    """
+    try:
+        readable, _, _ = select.select([ready_fd], [], [], timeout)
+        return bool(readable) and os.read(ready_fd, 1) == b'1'
+    finally:
+        os.close(ready_fd)
+
+
+def worker_main(argv):
+    """
+    工作进程入口: web_app.py --worker <序号> <工作进程数量> <监听socket描述符> <就绪通知管道描述符>
+    :param argv: 命令行参数
+    """
+    worker_index, workers, listen_fd, ready_fd = map(int, argv)
+    sock = socket.socket(fileno=listen_fd) if listen_fd >= 0 else None
+    try:
+        run_worker(worker_index, workers, sock, ready_fd)
+    except BaseException as e:
+        logging.exception(e)
+        sys.exit(1)
+
+
+def run_master(workers):
+    """
+    运行主进程: 创建工作进程并监控, 工作进程退出后重新创建,
+    收到SIGTERM或SIGINT时通知所有工作进程优雅退出,
+    收到SIGHUP时滚动重启: 逐个创建新工作进程, 新工作进程开始监听后再通知对应的旧工作进程优雅退出,
+    新工作进程使用新的代码和配置; 主进程本身不重新加载, 修改server.workers, host, port或unix_socket需要完全重启
+    :param workers: 工作进程数量
+    """
+    children = dict()
+    stopping = []
+    reloading = []
+
+    # 滚动重启时正在退出的旧工作进程, 退出后不需要重新创建
+    retiring = set()
+
+    # Unix域套接字不支持SO_REUSEPORT, 由主进程创建监听socket, 工作进程继承后共同accept
+    sock = create_listen_socket() if configs.server.unix_socket else None
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for child_pid in children:
+            try:
+                os.kill(child_pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reload(signum, frame):
+        # 信号处理函数中只做标记, 滚动重启在主循环中执行
+        reloading.append(signum)
+
+    def rolling_restart():
+        logging.info('master %s rolling restart' % os.getpid())
+        for child_pid, child_index in list(children.items()):
+            if stopping:
+                return
+            if child_pid in retiring:
+                continue
+            new_pid, ready_fd = spawn_worker(child_index, workers, sock)
+            children[new_pid] = child_index
+            # 等待新工作进程开始监听后, 再让旧工作进程停止接受连接
+            if not wait_ready(ready_fd):
+                logging.warning('worker %s (pid %s) not ready, keeping old worker %s' %
+                                (child_index, new_pid, child_pid))
+                continue
+            retiring.add(child_pid)
+            os.kill(child_pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    for i in range(workers):
+        pid, ready_fd = spawn_worker(i, workers, sock)
+        os.close(ready_fd)
+        children[pid] = i
+    logging.info('master %s started %s workers' % (os.getpid(), workers))
+
+    while children:
+        if reloading and not stopping:
+            del reloading[:]
+            rolling_restart()
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+
+        index = children.pop(pid, None)
+        if index is None or stopping or pid in retiring:
+            retiring.discard(pid)
+            continue
+
+        # 工作进程异常退出, 稍作等待后重新创建, 避免频繁崩溃时占满CPU
+        logging.warning('worker %s (pid %s) exited with status %s, restarting...' % (index, pid, status))
+        time.sleep(1)
+        pid, ready_fd = spawn_worker(index, workers, sock)
+        os.close(ready_fd)
+        children[pid] = index
+    logging.info('master %s stopped' % os.getpid())
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(init_app(loop))
-    loop.run_forever()
+    if len(sys.argv) == 6 and sys.argv[1] == '--worker':
+        worker_main(sys.argv[2:])
+        sys.exit(0)
+
+    worker_count = resolve_workers()
+    if worker_count > 1:
+        run_master(worker_count)
+    else:
+        run_worker()
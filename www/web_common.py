@@ -72,6 +72,18 @@ class QueryStringParser(object):
         """
         return key in self.__kw
 
+    def get_int(self, key, default=0):
+        """
+        获取整数属性
+        :param key: 属性名称
+        :param default: 属性不存在或者不是整数时返回的默认值
+        :return: 属性值(整数)
+        """
+        try:
+            return int(self.__kw[key])
+        except (KeyError, ValueError):
+            return default
+
     def __getattr__(self, key):
         """
         属性获取
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+响应压缩
+没有nginx在前面时(本地或其他部署方式), 由中间件对超过大小阈值的HTML和JSON响应进行gzip压缩
+压缩结果按响应内容的摘要缓存, 内容相同的热门页面只压缩一次
+"""
+
+import gzip
+import hashlib
+from collections import OrderedDict
+
+import web_metrics
+
+__author__ = 'Burnell Liu'
+
+
+# 可以压缩的内容类型
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'application/rss+xml', 'application/atom+xml')
+
+_enabled = True
+_threshold = 1024
+_level = 6
+_cache_size = 128
+
+# 响应内容摘要 -> 压缩后的内容
+_cache = OrderedDict()
+
+
+def init(enabled=True, threshold=1024, level=6, cache_size=128):
+    """
+    初始化压缩参数
+    :param enabled: 是否启用压缩
+    :param threshold: 响应内容超过该大小(字节)时才压缩
+    :param level: gzip压缩级别(1~9)
+    :param cache_size: 缓存的压缩结果数量, 为0时不缓存
+    """
+    global _enabled, _threshold, _level, _cache_size
+    _enabled = enabled
+    _threshold = threshold
+    _level = level
+    _cache_size = cache_size
+    _cache.clear()
+
+
+def accepts_gzip(request):
+    """
+    客户端是否接受gzip编码
+    :param request: 请求对象
+    :return: 接受返回True
+    """
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = item.partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def compressible(response):
+    """
+    响应是否需要压缩: 内容类型可以压缩, 没有编码过, 并且内容超过大小阈值
+    :param response: 响应对象
+    :return: 需要压缩返回True
+    """
+    if not _enabled or response.status != 200 or 'Content-Encoding' in response.headers:
+        return False
+    body = response.body
+    if not isinstance(body, bytes) or len(body) < _threshold:
+        return False
+    return response.content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def gzip_body(body):
+    """
+    压缩响应内容, 相同内容的压缩结果从缓存中获取
+    :param body: 响应内容
+    :return: 压缩后的内容
+    """
+    if _cache_size <= 0:
+        return gzip.compress(body, _level)
+
+    key = hashlib.sha1(body).digest()
+    compressed = _cache.get(key)
+    if compressed is not None:
+        _cache.move_to_end(key)
+        web_metrics.CACHE_REQUESTS.inc(cache='compress', result='hit')
+        return compressed
+
+    web_metrics.CACHE_REQUESTS.inc(cache='compress', result='miss')
+    compressed = gzip.compress(body, _level)
+    _cache[key] = compressed
+    while len(_cache) > _cache_size:
+        _cache.popitem(last=False)
+    return compressed
+
+
+def size():
+    """
+    获取缓存的压缩结果数量
+    :return: 数量
+    """
+    return len(_cache)
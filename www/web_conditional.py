@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+条件请求
+路由函数通过 @conditional(validator) 指定验证器, 验证器只查询版本戳(博客和评论的更新时间, 数量等), 不渲染页面
+请求带有If-None-Match或If-Modified-Since并且版本没有变化时, 在执行路由函数前直接返回304
+页面中的阅读次数, 热门和趋势博客不属于版本戳, 通过时间段(max_stale)限制它们的过期时间
+与登录用户无关的内容(订阅源, 站点地图)使用共享验证器, 版本戳中不加入用户和时间段, 允许代理缓存
+验证器查询到的数据保存在请求对象中(例如request['blog_types']), 执行路由函数时直接复用, 不再重复查询
+"""
+
+import hashlib
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+from aiohttp import web
+
+from db_orm import select
+from db_models import BlogType
+
+__author__ = 'Burnell Liu'
+
+
+# 验证器的时间段长度(秒), 为0时不使用时间段
+_max_stale = 300
+
+# 进程内缓存查询博客列表版本戳的最小间隔(秒)
+_version_interval = 1.0
+
+# (查询时间, 博客列表版本戳)
+_current_blogs_version = None
+
+
+def init(max_stale=300, version_interval=1.0):
+    """
+    初始化条件请求参数
+    :param max_stale: 验证器的时间段长度(秒), 不属于版本戳的页面内容最多过期该时间
+    :param version_interval: 进程内缓存查询博客列表版本戳的最小间隔(秒)
+    """
+    global _max_stale, _version_interval, _current_blogs_version
+    _max_stale = max_stale
+    _version_interval = version_interval
+    _current_blogs_version = None
+
+
+def conditional(validator, not_modified=None, shared=False):
+    """
+    定义装饰器 @conditional(validator), 放在@get装饰器下面
+    :param validator: 验证器协程函数, 参数为请求对象, 返回(版本信息列表, 最后修改时间), 返回None时不进行条件请求处理
+    :param not_modified: 返回304时执行的协程函数(比如增加阅读次数), 参数为请求对象
+    :param shared: 响应内容是否与登录用户无关并且完全由版本戳决定
+    """
+    def decorator(func):
+        func.__validator__ = validator
+        func.__not_modified__ = not_modified
+        func.__shared__ = shared
+        return func
+    return decorator
+
+
+def make_validators(request, parts, last_modified, shared=False):
+    """
+    生成弱ETag和最后修改时间, 非共享的版本信息中加入当前用户和时间段
+    弱ETag允许响应被压缩后仍然使用同一个ETag
+    :param request: 请求对象
+    :param parts: 版本信息列表
+    :param last_modified: 最后修改时间
+    :param shared: 是否为共享验证器
+    :return: (ETag, 最后修改时间)
+    """
+    bucket = 0
+    user_id = ''
+    if not shared:
+        if _max_stale > 0:
+            bucket = int(time.time() // _max_stale) * _max_stale
+        user = getattr(request, '__user__', None)
+        user_id = user['id'] if user else ''
+    digest = hashlib.sha1(repr((list(parts), user_id, bucket)).encode('utf-8')).hexdigest()[:20]
+    return 'W/"%s"' % digest, max(last_modified or 0, bucket)
+
+
+def is_not_modified(request, etag, last_modified):
+    """
+    判断客户端缓存是否仍然有效, 同时存在If-None-Match时忽略If-Modified-Since
+    :param request: 请求对象
+    :param etag: ETag
+    :param last_modified: 最后修改时间
+    :return: 有效返回True
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = list(map(lambda t: t.strip(), if_none_match.split(',')))
+        return '*' in tags or etag in tags or etag[2:] in tags
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+    return False
+
+
+def set_validators(response, etag, last_modified, shared=False):
+    """
+    设置响应的验证器响应头, 页面内容与登录用户相关, 只允许浏览器缓存, 每次使用前需要验证
+    共享的内容允许代理缓存, 同样每次使用前需要验证
+    :param response: 响应对象
+    :param etag: ETag
+    :param last_modified: 最后修改时间
+    :param shared: 是否为共享验证器
+    """
+    response.headers['ETag'] = etag
+    if last_modified:
+        response.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    if shared:
+        response.headers['Cache-Control'] = 'public, no-cache'
+        return
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Cookie'
+
+
+async def blogs_version(blog_type=None):
+    """
+    查询博客列表的版本戳: 最后更新时间和博客数量(数量用于发现删除)
+    :param blog_type: 博客类型, 为None时查询所有博客
+    :return: (最后更新时间, 博客数量)
+    """
+    sql = 'select max(`updated_at`) _updated_, count(`id`) _num_ from `blogs`'
+    args = []
+    if blog_type is not None:
+        sql += ' where `type`=?'
+        args.append(blog_type)
+    rs = await select(sql, args, 1)
+    return rs[0]['_updated_'] or 0, rs[0]['_num_']
+
+
+async def current_blogs_version():
+    """
+    获取所有博客的版本戳, 供进程内缓存(热门博客, 搜索索引, 相关博客)判断是否需要与数据库同步
+    每个进程最多每version_interval秒查询一次, 多进程部署时其他进程的修改最多延迟该时间后被发现
+    :return: (最后更新时间, 博客数量)
+    """
+    global _current_blogs_version
+    now = time.monotonic()
+    if _current_blogs_version is not None and now - _current_blogs_version[0] < _version_interval:
+        return _current_blogs_version[1]
+    version = await blogs_version()
+    _current_blogs_version = (now, version)
+    return version
+
+
+async def blog_version(blog_id):
+    """
+    查询博客的版本戳
+    :param blog_id: 博客ID
+    :return: (创建时间, 更新时间), 博客不存在时返回None
+    """
+    rs = await select('select `created_at`, `updated_at` from `blogs` where `id`=?', [blog_id], 1)
+    if len(rs) == 0:
+        return None
+    return rs[0]['created_at'], rs[0]['updated_at']
+
+
+async def comments_version(blog_id):
+    """
+    查询博客评论的版本戳: 最后更新时间和评论数量
+    :param blog_id: 博客ID
+    :return: (最后更新时间, 评论数量)
+    """
+    rs = await select('select max(`updated_at`) _updated_, count(`id`) _num_ from `comments` where `blog_id`=?',
+                      [blog_id], 1)
+    return rs[0]['_updated_'] or 0, rs[0]['_num_']
+
+
+async def blog_types_version(request=None):
+    """
+    查询博客类型的版本信息(页面导航栏使用), 博客类型很少, 直接使用全部类型
+    :param request: 请求对象, 不为None时将查询到的博客类型保存在request['blog_types']中, 供渲染页面时复用
+    :return: 博客类型列表
+    """
+    types = await BlogType.find_all(order_by='level asc')
+    if request is not None:
+        request['blog_types'] = types
+    return list(map(lambda t: (t.id, t.name, t.level), types))
+
+
+def not_modified_response(etag, last_modified, shared=False):
+    """
+    生成304响应
+    :param etag: ETag
+    :param last_modified: 最后修改时间
+    :param shared: 是否为共享验证器
+    :return: 响应对象
+    """
+    r = web.HTTPNotModified()
+    set_validators(r, etag, last_modified, shared)
+    return r
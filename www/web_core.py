@@ -5,7 +5,11 @@ import functools
 import inspect
 import asyncio
 import logging
+import mimetypes
 import os
+import stat
+
+from aiohttp import web
 
 
 __author__ = 'Burnell Liu'
@@ -43,15 +47,119 @@ def post(path):
     return decorator
 
 
+# 预压缩文件的编码和后缀名, 按优先顺序排列
+_PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _accepted_encodings(request):
+    """
+    解析请求头Accept-Encoding
+    :param request: 请求对象
+    :return: 客户端接受的编码集合(不包含q=0的编码)
+    """
+    encodings = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        if params in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def _file_mtime(path):
+    """
+    获取普通文件的修改时间
+    :param path: 文件路径
+    :return: 修改时间, 文件不存在或者不是普通文件时返回None
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime if stat.S_ISREG(st.st_mode) else None
+
+
+def _static_handler(root):
+    """
+    生成静态文件处理函数: 客户端接受br或gzip编码, 并且存在不比原文件旧的预压缩文件(.br或.gz)时,
+    直接返回预压缩文件, 文件内容通过sendfile发送, 不需要在每次请求时压缩
+    文件路径和预压缩文件的查找结果按原文件的修改时间缓存, 原文件没有变化时每次请求只需要一次stat
+    :param root: 静态文件目录
+    :return: 处理函数
+    """
+    root = os.path.realpath(root)
+
+    # 请求路径 -> (文件路径, 修改时间, 内容类型, [(编码, 预压缩文件路径)])
+    lookups = dict()
+
+    def lookup(rel_path):
+        cached = lookups.get(rel_path)
+        if cached is not None:
+            mtime = _file_mtime(cached[0])
+            if mtime == cached[1]:
+                return cached
+            lookups.pop(rel_path, None)
+            if mtime is None:
+                return None
+
+        path = os.path.realpath(os.path.join(root, rel_path))
+        if not path.startswith(root + os.sep):
+            return None
+        mtime = _file_mtime(path)
+        if mtime is None:
+            return None
+        variants = []
+        for encoding, suffix in _PRECOMPRESSED:
+            compressed_mtime = _file_mtime(path + suffix)
+            if compressed_mtime is not None:
+                # 比原文件旧的预压缩文件已经过期, 不使用, 但仍然需要设置Vary
+                variants.append((encoding, path + suffix if compressed_mtime >= mtime else None))
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        lookups[rel_path] = (path, mtime, content_type, variants)
+        return lookups[rel_path]
+
+    async def handler(request):
+        found = lookup(request.match_info['path'])
+        if found is None:
+            raise web.HTTPNotFound()
+        path, _, content_type, variants = found
+
+        accepted = _accepted_encodings(request) if variants else ()
+        for encoding, compressed in variants:
+            if encoding not in accepted or compressed is None:
+                continue
+            r = web.FileResponse(compressed)
+            r.content_type = content_type
+            r.headers['Content-Encoding'] = encoding
+            r.headers['Vary'] = 'Accept-Encoding'
+            return r
+
+        r = web.FileResponse(path)
+        if variants:
+            r.headers['Vary'] = 'Accept-Encoding'
+        return r
+
+    return handler
+
+
 def add_static(app):
     """
-    添加静态资源到WEB APP对象中
+    添加静态资源到WEB APP对象中, 带指纹的静态资源(/static/dist/)内容不会变化, 设置为永久缓存
+    存在预压缩文件时根据Accept-Encoding返回预压缩文件
     :param app: WEB APP对象
     """
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
+    handler = _static_handler(path)
+    app.router.add_route('GET', '/static/{path:.+}', handler)
+    app.router.add_route('HEAD', '/static/{path:.+}', handler)
     logging.info('add static: prefix=%s, path=%s' % ('/static/', path))
 
+    async def on_prepare(request, response):
+        if request.path.startswith('/static/dist/') and not request.path.endswith('.json') and response.status == 200:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    app.on_response_prepare.append(on_prepare)
+
 
 def add_route(app, fn):
     """
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+执行器
+将CPU密集或阻塞的任务从事件循环中移到线程池或进程池中执行, 避免阻塞其他连接,
+并统计每类任务的排队等待时间和执行时间
+"""
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+__author__ = 'Burnell Liu'
+
+
+_loop = None
+_thread_pool = None
+_process_pool = None
+
+# 任务名称 -> 统计信息
+_stats = dict()
+
+
+def init(loop, threads=4, processes=2):
+    """
+    初始化线程池和进程池
+    :param loop: 事件循环对象
+    :param threads: 线程池大小
+    :param processes: 进程池大小, 为0时进程任务在线程池中执行
+    """
+    global _loop, _thread_pool, _process_pool
+    _loop = loop
+    _thread_pool = ThreadPoolExecutor(max_workers=threads)
+    if processes > 0:
+        _process_pool = ProcessPoolExecutor(max_workers=processes)
+
+
+def shutdown(wait=True):
+    """
+    关闭线程池和进程池
+    :param wait: 是否等待正在执行的任务完成
+    """
+    global _thread_pool, _process_pool
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=wait)
+        _thread_pool = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=wait)
+        _process_pool = None
+
+
+def _timed_call(fn, args, kw, submit_time):
+    """
+    在工作线程或工作进程中执行任务, 并记录开始和结束时间
+    :param fn: 任务函数
+    :param args: 位置参数
+    :param kw: 关键字参数
+    :param submit_time: 任务提交时间
+    :return: (任务结果, 排队等待时间, 执行时间)
+    """
+    start = time.time()
+    result = fn(*args, **kw)
+    return result, start - submit_time, time.time() - start
+
+
+def _record(name, wait, run):
+    """
+    记录任务统计信息
+    :param name: 任务名称
+    :param wait: 排队等待时间
+    :param run: 执行时间
+    """
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats[name] = dict(count=0, wait_total=0.0, wait_max=0.0, run_total=0.0, run_max=0.0)
+    stats['count'] += 1
+    stats['wait_total'] += wait
+    stats['wait_max'] = max(stats['wait_max'], wait)
+    stats['run_total'] += run
+    stats['run_max'] = max(stats['run_max'], run)
+
+
+async def _run(executor, fn, args, kw):
+    loop = _loop or asyncio.get_event_loop()
+    call = functools.partial(_timed_call, fn, args, kw, time.time())
+    result, wait, run = await loop.run_in_executor(executor, call)
+    _record(getattr(fn, '__qualname__', repr(fn)), max(wait, 0.0), run)
+    return result
+
+
+async def run_in_thread(fn, *args, **kw):
+    """
+    在线程池中执行阻塞任务(文件读写等)
+    :param fn: 任务函数
+    :return: 任务结果
+    """
+    return await _run(_thread_pool, fn, args, kw)
+
+
+async def run_in_process(fn, *args, **kw):
+    """
+    在进程池中执行CPU密集任务(Markdown渲染, 图片处理等), 函数和参数必须可以被pickle
+    :param fn: 任务函数
+    :return: 任务结果
+    """
+    return await _run(_process_pool or _thread_pool, fn, args, kw)
+
+
+def get_stats():
+    """
+    获取任务统计信息
+    :return: 任务名称 -> 统计信息(count, wait_avg, wait_max, run_avg, run_max)
+    """
+    result = dict()
+    for name, stats in _stats.items():
+        count = stats['count']
+        result[name] = dict(
+            count=count,
+            wait_avg=stats['wait_total'] / count,
+            wait_max=stats['wait_max'],
+            run_avg=stats['run_total'] / count,
+            run_max=stats['run_max'])
+    return result
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+应用生命周期
+管理启动和关闭钩子, 收到SIGTERM或SIGINT时优雅关闭:
+停止接受新连接, 在期限内等待正在处理的请求完成, 执行关闭钩子(刷新缓冲区, 关闭连接池等), 最后停止事件循环
+"""
+
+import asyncio
+import inspect
+import logging
+import signal
+import time
+
+__author__ = 'Burnell Liu'
+
+
+_startup_hooks = []
+_shutdown_hooks = []
+
+_server = None
+_handler = None
+
+# 正在处理的请求数量
+_in_flight = 0
+
+# 标记是否正在关闭
+_shutting_down = False
+
+
+def on_startup(hook):
+    """
+    注册启动钩子, 在开始接受连接前按注册顺序执行
+    :param hook: 钩子函数, 可以是普通函数或协程函数
+    :return: 钩子函数
+    """
+    _startup_hooks.append(hook)
+    return hook
+
+
+def on_shutdown(hook):
+    """
+    注册关闭钩子, 在请求处理完成后按注册的相反顺序执行
+    :param hook: 钩子函数, 可以是普通函数或协程函数
+    :return: 钩子函数
+    """
+    _shutdown_hooks.append(hook)
+    return hook
+
+
+async def _call(hook):
+    r = hook()
+    if inspect.isawaitable(r):
+        await r
+
+
+async def startup():
+    """
+    执行所有启动钩子
+    """
+    for hook in _startup_hooks:
+        await _call(hook)
+
+
+def set_server(server, handler):
+    """
+    保存服务器对象和请求处理对象, 关闭时使用
+    :param server: 服务器对象
+    :param handler: 请求处理对象
+    """
+    global _server, _handler
+    _server = server
+    _handler = handler
+
+
+def is_shutting_down():
+    """
+    是否正在关闭
+    :return: 正在关闭返回True
+    """
+    return _shutting_down
+
+
+def request_started():
+    """
+    请求开始处理
+    """
+    global _in_flight
+    _in_flight += 1
+
+
+def request_finished():
+    """
+    请求处理完成
+    """
+    global _in_flight
+    _in_flight -= 1
+
+
+async def shutdown(timeout=30.0):
+    """
+    优雅关闭: 停止接受新连接, 等待正在处理的请求完成, 执行关闭钩子
+    :param timeout: 等待请求完成的期限(秒)
+    """
+    global _shutting_down
+    if _shutting_down:
+        return
+    _shutting_down = True
+    deadline = time.monotonic() + timeout
+
+    # 停止接受新连接(Python 3.12以后wait_closed会等待所有连接关闭, 包括空闲的长连接, 所以最后再等待)
+    if _server is not None:
+        _server.close()
+
+    # 等待正在处理的请求完成
+    logging.info('draining %s in-flight requests...' % _in_flight)
+    while _in_flight > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if _in_flight > 0:
+        logging.warning('shutdown deadline reached with %s in-flight requests' % _in_flight)
+
+    # 关闭空闲的长连接
+    if _handler is not None:
+        await _handler.shutdown(max(deadline - time.monotonic(), 0.0))
+
+    # 在剩余期限内等待服务器完全关闭
+    if _server is not None:
+        try:
+            await asyncio.wait_for(_server.wait_closed(), max(deadline - time.monotonic(), 0.0))
+        except asyncio.TimeoutError:
+            logging.warning('shutdown deadline reached before all connections were closed')
+
+    for hook in reversed(_shutdown_hooks):
+        try:
+            await _call(hook)
+        except Exception as e:
+            logging.exception(e)
+    logging.info('shutdown complete')
+
+
+def install_signal_handlers(loop, timeout=30.0):
+    """
+    设置信号处理: 收到SIGTERM或SIGINT时优雅关闭并停止事件循环
+    :param loop: 事件循环对象
+    :param timeout: 等待请求完成的期限(秒)
+    """
+    async def stop():
+        try:
+            await shutdown(timeout)
+        finally:
+            loop.stop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, lambda: asyncio.ensure_future(stop(), loop=loop))
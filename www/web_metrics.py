@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+监控指标注册表
+提供计数器(Counter), 仪表(Gauge), 直方图(Histogram)三类指标, 并以Prometheus文本格式输出
+"""
+
+import bisect
+
+__author__ = 'Burnell Liu'
+
+
+# 默认的直方图桶上限(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+# 所有已注册的指标
+_registry = []
+
+
+def _escape(value):
+    """
+    转义标签值
+    :param value: 标签值
+    :return: 转义后的字符串
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    """
+    格式化标签
+    :param names: 标签名列表
+    :param values: 标签值列表
+    :param extra: 额外的标签(名, 值)
+    :return: 标签字符串, 没有标签时返回空字符串
+    """
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(map(lambda p: '%s="%s"' % (p[0], _escape(p[1])), pairs))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    指标基类
+    """
+    type = 'untyped'
+
+    def __init__(self, name, documentation, label_names=()):
+        """
+        构造函数, 创建的指标会自动注册
+        :param name: 指标名称
+        :param documentation: 指标说明
+        :param label_names: 标签名列表
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = dict()
+        _registry.append(self)
+
+    def _key(self, labels):
+        """
+        根据标签生成取值的键
+        :param labels: 标签字典
+        :return: 标签值元组
+        """
+        if len(labels) != len(self.label_names):
+            raise ValueError('Invalid labels for metric %s: %s' % (self.name, labels))
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def samples(self):
+        """
+        生成指标的样本
+        :return: [(样本名称, 标签字符串, 值)]
+        """
+        return [(self.name, _format_labels(self.label_names, k), v) for k, v in self._values.items()]
+
+    def render(self):
+        """
+        以Prometheus文本格式输出指标
+        :return: 文本行列表
+        """
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend(map(lambda s: '%s%s %s' % (s[0], s[1], _format_value(s[2])), self.samples()))
+        return lines
+
+
+class Counter(Metric):
+    """
+    计数器, 只能增加
+    """
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        """
+        增加计数
+        :param value: 增加值
+        :param labels: 标签
+        """
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    """
+    仪表, 可以设置为任意值, 也可以在输出时通过收集函数获取当前值
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._collector = None
+
+    def set(self, value, **labels):
+        """
+        设置值
+        :param value: 值
+        :param labels: 标签
+        """
+        self._values[self._key(labels)] = value
+
+    def set_collector(self, collector):
+        """
+        设置收集函数, 输出指标前调用, 返回 标签字典 -> 值 的列表[(labels, value)]
+        :param collector: 收集函数
+        """
+        self._collector = collector
+
+    def samples(self):
+        if self._collector is not None:
+            for labels, value in self._collector():
+                self.set(value, **labels)
+        return super().samples()
+
+
+class Histogram(Metric):
+    """
+    直方图, 统计值的分布, 分位数可以通过桶计算
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """
+        记录一个值
+        :param value: 值
+        :param labels: 标签
+        """
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [[0] * len(self.buckets), 0, 0.0, 0.0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += 1
+        data[2] += value
+        data[3] = max(data[3], value)
+
+    def _quantile(self, data, q):
+        """
+        根据桶估算分位数(返回分位数所在桶的上限)
+        :param data: 取值数据[桶计数, 数量, 总和, 最大值]
+        :param q: 分位(0~1)
+        :return: 分位数估计值
+        """
+        counts, count, _, maximum = data
+        if count == 0:
+            return 0.0
+        rank = q * count
+        total = 0
+        for bound, n in zip(self.buckets, counts):
+            total += n
+            if total >= rank:
+                return bound if bound != float('inf') else maximum
+        return maximum
+
+    def summary(self, **labels):
+        """
+        获取值的分布摘要(数量, 平均值, 最大值, 分位数和各桶计数), 用于监控页面
+        :param labels: 标签
+        :return: 摘要字典
+        """
+        data = self._values.get(self._key(labels), [[0] * len(self.buckets), 0, 0.0, 0.0])
+        counts, count, total, maximum = data
+        return dict(
+            count=count,
+            avg=total / count if count else 0.0,
+            max=maximum,
+            p50=self._quantile(data, 0.5),
+            p90=self._quantile(data, 0.9),
+            p99=self._quantile(data, 0.99),
+            buckets=dict(('%g' % b, n) for b, n in zip(self.buckets, counts)))
+
+    def label_values(self):
+        """
+        获取已经记录过的标签值
+        :return: 标签字典列表
+        """
+        return [dict(zip(self.label_names, key)) for key in self._values]
+
+    def samples(self):
+        samples = []
+        for key, (counts, count, total, _) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else '%g' % bound
+                samples.append(('%s_bucket' % self.name, _format_labels(self.label_names, key, ('le', le)), cumulative))
+            labels = _format_labels(self.label_names, key)
+            samples.append(('%s_count' % self.name, labels, count))
+            samples.append(('%s_sum' % self.name, labels, total))
+        return samples
+
+
+def render():
+    """
+    以Prometheus文本格式输出所有指标
+    :return: 文本
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# 请求指标
+REQUESTS = Counter('http_requests_total', 'Total HTTP requests', ('route', 'status'))
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'HTTP request latency', ('route',))
+LOOP_LAG_SECONDS = Histogram('event_loop_lag_seconds', 'Event loop lag')
+
+# 数据库指标
+DB_QUERIES = Histogram('db_queries_per_request', 'Database queries per request',
+                       buckets=(0, 1, 2, 5, 10, 20, 50, float('inf')))
+DB_SECONDS = Histogram('db_seconds_per_request', 'Database time per request')
+DB_POOL = Gauge('db_pool_connections', 'Database pool connections', ('state',))
+
+# 模板渲染指标
+TEMPLATE_SECONDS = Histogram('template_render_seconds', 'Template render time', ('template',))
+
+# 缓存指标
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups', ('cache', 'result'))
+CACHE_SIZE = Gauge('cache_size', 'Cache size', ('cache',))
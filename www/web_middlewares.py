@@ -2,15 +2,120 @@
 # -*- coding: utf-8 -*-
 
 import json
+import logging
+import time
 
 from aiohttp import web
 from config import configs
 from session_cookie import user_cookie_parse
 from db_models import BlogType
+import db_orm
+import web_monitor
+import web_metrics
+import web_lifecycle
+import web_compress
+import web_conditional
 
 __author__ = 'Burnell Liu'
 
 
+async def monitor_factory(app, handler):
+    """
+    监控请求处理耗时的中间件, 按路由记录耗时分布和慢请求
+    :param app: WEB应用对象
+    :param handler: 处理请求对象
+    :return: 中间件处理对象
+    """
+    async def monitor(request):
+        start = time.perf_counter()
+        status = 500
+        try:
+            r = await handler(request)
+            status = getattr(r, 'status', 200)
+            return r
+        except web.HTTPException as e:
+            # 404, 重定向和304等以异常方式返回的响应按实际状态码统计
+            status = e.status
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            name = web_monitor.record_request(request, elapsed)
+            web_metrics.REQUESTS.inc(route=name, status=status)
+    return monitor
+
+
+async def drain_factory(app, handler):
+    """
+    统计正在处理的请求的中间件, 用于优雅关闭时等待请求完成,
+    关闭过程中的响应会关闭长连接, 让客户端(nginx)重新连接到其他工作进程
+    :param app: WEB应用对象
+    :param handler: 处理请求对象
+    :return: 中间件处理对象
+    """
+    async def drain(request):
+        web_lifecycle.request_started()
+        try:
+            r = await handler(request)
+        finally:
+            web_lifecycle.request_finished()
+        if web_lifecycle.is_shutting_down() and isinstance(r, web.StreamResponse) and not r.prepared:
+            r.force_close()
+        return r
+    return drain
+
+
+async def compress_factory(app, handler):
+    """
+    压缩响应的中间件, 客户端接受gzip编码时压缩超过大小阈值的HTML和JSON响应
+    :param app: WEB应用对象
+    :param handler: 处理请求对象
+    :return: 中间件处理对象
+    """
+    async def compress(request):
+        r = await handler(request)
+        if not isinstance(r, web.Response) or r.prepared or not web_compress.compressible(r):
+            return r
+
+        vary = r.headers.get('Vary')
+        r.headers['Vary'] = 'Accept-Encoding' if not vary else '%s, Accept-Encoding' % vary
+        if web_compress.accepts_gzip(request):
+            r.body = web_compress.gzip_body(r.body)
+            r.headers['Content-Encoding'] = 'gzip'
+        return r
+    return compress
+
+
+async def trace_factory(app, handler):
+    """
+    追踪请求查询的中间件, 统计请求执行的查询次数和耗时, 通过Server-Timing响应头返回,
+    查询次数超过阈值时记录警告日志, 用于发现N+1查询
+    :param app: WEB应用对象
+    :param handler: 处理请求对象
+    :return: 中间件处理对象
+    """
+    async def trace(request):
+        queries, token = db_orm.start_query_trace()
+        try:
+            r = await handler(request)
+        finally:
+            db_orm.stop_query_trace(token)
+
+        total = sum(map(lambda q: q[1], queries))
+        web_metrics.DB_QUERIES.observe(len(queries))
+        web_metrics.DB_SECONDS.observe(total)
+        if isinstance(r, web.StreamResponse) and not r.prepared:
+            r.headers['Server-Timing'] = 'db;dur=%.2f;desc="%s queries"' % (total * 1000, len(queries))
+
+        logging.debug('%s %s: %s queries, %.2fms' % (request.method, request.path_qs, len(queries), total * 1000))
+        max_queries = configs.trace.max_queries
+        if 0 < max_queries < len(queries):
+            lines = map(lambda q: '  %.2fms %s rows: %s' % (q[1] * 1000, q[2], q[0]), queries)
+            logging.warning('too many queries: %s %s: %s queries, %.2fms\n%s' %
+                            (request.method, request.path_qs, len(queries), total * 1000, '\n'.join(lines)))
+        return r
+    return trace
+
+
 async def logger_factory(app, handler):
     """
     记录URL日志的中间件, 请求被处理前进行写日志
@@ -49,6 +154,38 @@ async def auth_factory(app, handler):
     return auth
 
 
+async def conditional_factory(app, handler):
+    """
+    条件请求的中间件, 路由函数指定了验证器时, 先计算验证器, 客户端缓存仍然有效则直接返回304, 不执行路由函数,
+    否则执行路由函数并在响应中设置ETag和Last-Modified
+    :param app: WEB应用对象
+    :param handler: 处理请求对象
+    :return: 中间件处理对象
+    """
+    async def conditional(request):
+        route_handler = getattr(request.match_info, 'handler', None)
+        validator = getattr(route_handler, '__validator__', None)
+        if validator is None or request.method not in ('GET', 'HEAD'):
+            return await handler(request)
+
+        version = await validator(request)
+        if version is None:
+            return await handler(request)
+        shared = getattr(route_handler, '__shared__', False)
+        etag, last_modified = web_conditional.make_validators(request, *version, shared=shared)
+        if web_conditional.is_not_modified(request, etag, last_modified):
+            not_modified = getattr(route_handler, '__not_modified__', None)
+            if not_modified is not None:
+                await not_modified(request)
+            return web_conditional.not_modified_response(etag, last_modified, shared)
+
+        r = await handler(request)
+        if isinstance(r, web.StreamResponse) and not r.prepared and r.status == 200:
+            web_conditional.set_validators(r, etag, last_modified, shared)
+        return r
+    return conditional
+
+
 async def response_factory(app, handler):
     """
     处理响应的中间件, 请求被处理后需要转换为web.Response对象再返回, 以保证满足aiohttp的要求
@@ -76,7 +213,10 @@ async def response_factory(app, handler):
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
-                types = await BlogType.find_all(order_by='level asc')
+                # 验证器已经查询过博客类型时直接复用
+                types = request.get('blog_types')
+                if types is None:
+                    types = await BlogType.find_all(order_by='level asc')
                 r['blog_types'] = types
 
                 # 从请求中取出用户信息
@@ -89,7 +229,10 @@ async def response_factory(app, handler):
 
                 templating_env = app['__templating__']
                 template = templating_env.get_template(template_file_name)
-                resp = web.Response(body=template.render(**r).encode('utf-8'))
+                start = time.perf_counter()
+                body = template.render(**r).encode('utf-8')
+                web_metrics.TEMPLATE_SECONDS.observe(time.perf_counter() - start, template=template_file_name)
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+事件循环监控
+定期采样事件循环延迟, 记录每个路由的处理耗时分布(与Prometheus指标共用web_metrics中的直方图),
+事件循环被阻塞超过阈值时, 由监控线程采集事件循环线程的调用栈, 用于定位阻塞事件循环的代码
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import web_metrics
+
+__author__ = 'Burnell Liu'
+
+
+# 最多保存的阻塞调用栈数量
+_MAX_BLOCK_SAMPLES = 20
+
+_interval = 0.5
+_block_threshold = 0.2
+_slow_handler = 1.0
+
+# 事件循环线程ID和最近一次心跳时间
+_loop_thread_id = None
+_heartbeat = time.monotonic()
+
+# 当前阻塞是否已经采集过调用栈
+_block_captured = False
+
+
+# 最近的阻塞调用栈
+_block_samples = deque(maxlen=_MAX_BLOCK_SAMPLES)
+
+# 最近的慢请求
+_slow_requests = deque(maxlen=_MAX_BLOCK_SAMPLES)
+
+
+async def _sample_lag():
+    """
+    定期采样事件循环延迟: 实际睡眠时间超出预期的部分即为事件循环延迟
+    """
+    global _heartbeat, _block_captured
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(_interval)
+        web_metrics.LOOP_LAG_SECONDS.observe(max(loop.time() - start - _interval, 0.0))
+        _heartbeat = time.monotonic()
+        _block_captured = False
+
+
+def _watchdog():
+    """
+    监控线程: 心跳超时说明事件循环被阻塞, 采集事件循环线程的调用栈
+    """
+    global _block_captured
+    while True:
+        time.sleep(_interval / 2)
+        blocked = time.monotonic() - _heartbeat - _interval
+        if blocked < _block_threshold or _block_captured:
+            continue
+        frame = sys._current_frames().get(_loop_thread_id)
+        if frame is None:
+            continue
+        _block_captured = True
+        stack = traceback.format_stack(frame)
+        _block_samples.append(dict(time=time.time(), blocked=blocked, stack=stack))
+        logging.warning('event loop blocked for %.3fs:\n%s' % (blocked, ''.join(stack)))
+
+
+def init(loop, interval=0.5, block_threshold=0.2, slow_handler=1.0):
+    """
+    启动事件循环延迟采样和监控线程
+    :param loop: 事件循环对象
+    :param interval: 采样间隔(秒)
+    :param block_threshold: 事件循环阻塞超过该时间(秒)时采集调用栈
+    :param slow_handler: 请求处理超过该时间(秒)时记录慢请求
+    """
+    global _interval, _block_threshold, _slow_handler, _loop_thread_id, _heartbeat
+    _interval = interval
+    _block_threshold = block_threshold
+    _slow_handler = slow_handler
+    _loop_thread_id = threading.get_ident()
+    _heartbeat = time.monotonic()
+    asyncio.ensure_future(_sample_lag(), loop=loop)
+    threading.Thread(target=_watchdog, name='loop-watchdog', daemon=True).start()
+
+
+def route_name(request):
+    """
+    获取请求对应的路由名称, 使用路由模板而不是实际路径, 避免路由数量无限增长
+    :param request: 请求对象
+    :return: 路由名称
+    """
+    route = getattr(request.match_info, 'route', None)
+    resource = getattr(route, 'resource', None)
+    if resource is None:
+        return '%s <unmatched>' % request.method
+    info = resource.get_info()
+    path = info.get('formatter') or info.get('path') or info.get('prefix') or request.path
+    return '%s %s' % (request.method, path)
+
+
+def record_request(request, elapsed):
+    """
+    记录请求处理耗时
+    :param request: 请求对象
+    :param elapsed: 处理耗时(秒)
+    :return: 路由名称
+    """
+    name = route_name(request)
+    web_metrics.REQUEST_SECONDS.observe(elapsed, route=name)
+    if elapsed >= _slow_handler:
+        _slow_requests.append(dict(time=time.time(), route=name, path=request.path_qs, elapsed=elapsed))
+        logging.warning('slow handler: %s %s %.3fs' % (request.method, request.path_qs, elapsed))
+    return name
+
+
+def get_metrics():
+    """
+    获取监控数据
+    :return: 监控数据字典
+    """
+    return dict(
+        loop_lag=web_metrics.LOOP_LAG_SECONDS.summary(),
+        routes=dict((labels['route'], web_metrics.REQUEST_SECONDS.summary(**labels))
+                    for labels in web_metrics.REQUEST_SECONDS.label_values()),
+        slow_requests=list(_slow_requests),
+        block_samples=list(_block_samples))
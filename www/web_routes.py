@@ -9,15 +9,40 @@ import markdown2
 
 from config import configs
 from web_core import get
+from web_conditional import conditional, blogs_version, comments_version, blog_types_version
+from db_orm import execute
 from web_common import *
-from db_models import Comment, Blog
+from db_models import Blog
 from web_error import data_error
+from comment_cache import get_comments
+import hot_blogs
+import trending
+import web_executor
+import web_monitor
+import captcha_pool
+import web_metrics
+import image_derivatives
+import search
+import related
+import feeds
+import web_compress
 
 
 __author__ = 'Burnell Liu'
 
 
+async def _index_version(request):
+    """
+    首页验证器: 博客列表的版本戳
+    :param request: 请求对象
+    :return: (版本信息列表, 最后修改时间)
+    """
+    updated_at, num = await blogs_version()
+    return [updated_at, num, await blog_types_version(request)], updated_at
+
+
 @get('/')
+@conditional(_index_version)
 async def index(request):
     """
     WEB APP首页路由函数
@@ -27,7 +52,6 @@ async def index(request):
 
     # 以创建时间降序的方式查找指定的博客
     blogs = await Blog.find_all(order_by='created_at desc', limit=(0, 4))
-    hot_blogs = await Blog.find_all(order_by='read_times desc', limit=(0, 10))
     new_blog = None
     if len(blogs) > 0:
         new_blog = blogs[0]
@@ -35,11 +59,25 @@ async def index(request):
         '__template__': 'index.html',
         'new_blog': new_blog,
         'blogs': blogs[1:],
-        'hot_blogs': hot_blogs
+        'hot_blogs': await hot_blogs.get_hot_blogs()
     }
 
 
+async def _blogs_list_version(request):
+    """
+    博客列表页面验证器: 指定类型的博客列表的版本戳
+    :param request: 请求对象
+    :return: (版本信息列表, 最后修改时间)
+    """
+    blog_type = QueryStringParser(request.query_string).type
+    if not blog_type or blog_type == 'None':
+        blog_type = None
+    updated_at, num = await blogs_version(blog_type)
+    return [updated_at, num, await blog_types_version(request)], updated_at
+
+
 @get('/blogs')
+@conditional(_blogs_list_version)
 async def blogs_list(request):
     """
     博客列表路由函数
@@ -64,7 +102,7 @@ async def blogs_list(request):
 
     if num == 0:
         blogs = []
-        hot_blogs = []
+        hot_list = []
     else:
         # 以创建时间降序的方式查找指定的博客
         if blog_type != 'None':
@@ -73,29 +111,57 @@ async def blogs_list(request):
                 [blog_type],
                 order_by='created_at desc',
                 limit=(page.offset, page.limit))
-            hot_blogs = await Blog.find_all(
-                'type=?',
-                [blog_type],
-                order_by='read_times desc',
-                limit=(0, 10))
+            hot_list = await hot_blogs.get_hot_blogs(blog_type)
         else:
             blogs = await Blog.find_all(
                 order_by='created_at desc',
                 limit=(page.offset, page.limit))
-            hot_blogs = await Blog.find_all(
-                order_by='read_times desc',
-                limit=(0, 10))
+            hot_list = await hot_blogs.get_hot_blogs()
 
     return {
         '__template__': 'blog_list.html',
         'page': page,
         'blogs': blogs,
-        'hot_blogs': hot_blogs,
+        'hot_blogs': hot_list,
+        'trending_blogs': trending.get_trending_blogs(),
         'list_type': blog_type
     }
 
 
+async def _blog_detail_version(request):
+    """
+    博客详细页面验证器: 博客和博客评论的版本戳
+    查询到的博客和评论版本戳保存在request['blog']和request['comments_version']中, 供路由函数复用
+    :param request: 请求对象
+    :return: (版本信息列表, 最后修改时间), 博客不存在时返回None
+    """
+    blog_id = request.match_info['blog_id']
+    blog = await Blog.find(blog_id)
+    if blog is None:
+        return None
+    request['blog'] = blog
+    version = (blog.created_at, blog.updated_at)
+    comments_updated_at, comments_num = request['comments_version'] = await comments_version(blog_id)
+    # 相关博客只在其成员或成员的内容变化时改变页面, 不使用全站博客的版本戳
+    await related.ensure_fresh()
+    last_modified = max(version[0], version[1], comments_updated_at)
+    return [version, comments_updated_at, comments_num, related.get_related_versions(blog_id),
+            await blog_types_version(request)], last_modified
+
+
+async def _blog_detail_not_modified(request):
+    """
+    博客详细页面返回304时仍然增加阅读次数
+    :param request: 请求对象
+    """
+    blog_id = request.match_info['blog_id']
+    await execute('update `blogs` set `read_times`=`read_times`+1 where `id`=?', [blog_id])
+    hot_blogs.on_read_id(blog_id)
+    trending.record_view(blog_id)
+
+
 @get('/blog/{blog_id}')
+@conditional(_blog_detail_version, _blog_detail_not_modified)
 async def blog_detail(request):
     """
     博客详细页面路由函数
@@ -105,27 +171,131 @@ async def blog_detail(request):
 
     blog_id = request.match_info['blog_id']
 
-    # 根据博客ID找到博客详细内容
-    blog = await Blog.find(blog_id)
+    # 根据博客ID找到博客详细内容(验证器已经查询过时直接复用)
+    blog = request.get('blog')
+    if blog is None:
+        blog = await Blog.find(blog_id)
     if not blog:
         return data_error(u'非法blog id')
 
     # 阅读次数增加
     blog.read_times += 1
     await blog.update()
-
-    # 找到指定博客ID的博客的评论
-    comments = await Comment.find_all('blog_id=?', [blog_id], order_by='created_at asc')
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content, extras=["fenced-code-blocks"])
+    hot_blogs.on_read(blog)
+    trending.record_view(blog.id)
+
+    # 找到指定博客ID的博客的评论(优先从缓存中获取)
+    comments = await get_comments(blog_id, request.get('comments_version'))
+    await related.ensure_fresh()
+    # Markdown渲染是CPU密集任务, 在进程池中执行, 避免阻塞事件循环
+    blog.html_content = await web_executor.run_in_process(
+        markdown2.markdown, blog.content, extras=["fenced-code-blocks"])
     return {
         '__template__': 'blog_detail.html',
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'related_blogs': related.get_related(blog_id)
+    }
+
+
+@get('/search')
+async def blogs_search(request):
+    """
+    博客搜索页面路由函数
+    :param request: 请求对象
+    :return: 搜索结果页面
+    """
+    qs_parser = QueryStringParser(request.query_string)
+    # 页码不是正整数时使用第一页
+    page_index = max(qs_parser.get_int('page', 1), 1)
+    query = (qs_parser.q or '').strip()
+
+    page_size = 10
+    await search.ensure_synced()
+    num, blogs = search.search(query, offset=(page_index - 1) * page_size, limit=page_size)
+    page = Pagination(num, page_index, page_size)
+    return {
+        '__template__': 'blog_search.html',
+        'page': page,
+        'blogs': blogs,
+        'query': query
     }
 
 
+def _xml_response(request, document, content_type):
+    """
+    生成XML文档响应, 客户端接受gzip编码时直接发送预压缩的文档
+    :param request: 请求对象
+    :param document: (文档内容, gzip压缩后的文档内容)
+    :param content_type: 内容类型
+    :return: 响应对象
+    """
+    body, gzip_body = document
+    r = web.Response(content_type=content_type, charset='utf-8')
+    r.headers['Vary'] = 'Accept-Encoding'
+    if web_compress.accepts_gzip(request):
+        r.body = gzip_body
+        r.headers['Content-Encoding'] = 'gzip'
+    else:
+        r.body = body
+    return r
+
+
+async def _feed_version(request):
+    """
+    订阅源验证器: 博客列表的版本戳, 保存在request['blogs_version']中供路由函数复用
+    :param request: 请求对象
+    :return: (版本信息列表, 最后修改时间)
+    """
+    updated_at, num = request['blogs_version'] = await blogs_version()
+    return [updated_at, num], updated_at
+
+
+@get('/feed.xml')
+@conditional(_feed_version, shared=True)
+async def feed(request):
+    """
+    RSS订阅源路由函数
+    :param request: 请求对象
+    :return: 最新博客的RSS文档
+    """
+    version = request.get('blogs_version')
+    if version is None:
+        version = await blogs_version()
+    document = await feeds.get_feed(version)
+    return _xml_response(request, document, 'application/rss+xml')
+
+
+async def _sitemap_version(request):
+    """
+    站点地图验证器: 博客列表和博客类型的版本戳,
+    保存在request['blogs_version']和request['blog_types_version']中供路由函数复用
+    :param request: 请求对象
+    :return: (版本信息列表, 最后修改时间)
+    """
+    updated_at, num = request['blogs_version'] = await blogs_version()
+    types = request['blog_types_version'] = await blog_types_version()
+    return [updated_at, num, types], updated_at
+
+
+@get('/sitemap.xml')
+@conditional(_sitemap_version, shared=True)
+async def sitemap(request):
+    """
+    站点地图路由函数
+    :param request: 请求对象
+    :return: 站点地图文档
+    """
+    version = request.get('blogs_version')
+    if version is None:
+        version = await blogs_version()
+    types = request.get('blog_types_version')
+    if types is None:
+        types = await blog_types_version()
+    document = await feeds.get_sitemap(version, types)
+    return _xml_response(request, document, 'application/xml')
+
+
 @get('/register')
 def user_register(request):
     """
@@ -134,7 +304,8 @@ def user_register(request):
     :return: 用户注册页面
     """
     return {
-        '__template__': 'user_register.html'
+        '__template__': 'user_register.html',
+        'verify_image_raw': configs.verify_image.raw
     }
 
 
@@ -237,6 +408,31 @@ def manage_edit_blog(request):
     }
 
 
+@get('/manage/metrics')
+def manage_metrics(request):
+    """
+    监控数据路由函数(JSON), 包含事件循环延迟, 路由耗时分布, 慢请求, 阻塞调用栈和执行器统计
+    :param request: 请求对象
+    :return: 监控数据
+    """
+    metrics = web_monitor.get_metrics()
+    metrics['executor'] = web_executor.get_stats()
+    metrics['captcha_pool'] = captcha_pool.get_stats()
+    return metrics
+
+
+@get('/manage/metrics/prometheus')
+def manage_metrics_prometheus(request):
+    """
+    监控指标路由函数, 以Prometheus文本格式输出所有指标
+    :param request: 请求对象
+    :return: 指标文本
+    """
+    r = web.Response(body=web_metrics.render().encode('utf-8'))
+    r.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return r
+
+
 @get('/manage/comments')
 def manage_comments(request):
     """
@@ -247,3 +443,19 @@ def manage_comments(request):
     return {
         '__template__': 'manage_comments.html'
     }
+
+
+@get('/static/img/w{width:\\d+}/{path:.+}')
+async def image_derivative(request):
+    """
+    衍生图片路由函数, 衍生图片不存在时生成后返回, 之后由静态文件服务直接返回
+    :param request: 请求对象
+    :return: 衍生图片
+    """
+    width = int(request.match_info['width'])
+    path = await image_derivatives.ensure_derivative(width, request.match_info['path'])
+    if path is None:
+        raise web.HTTPNotFound()
+    r = web.FileResponse(path)
+    r.headers['Cache-Control'] = 'public, max-age=2592000'
+    return r